@@ -0,0 +1,172 @@
+import logging
+import threading
+import time
+import traceback
+from collections import Counter, defaultdict
+from contextlib import ExitStack
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger('foodgram.instrumentation')
+
+current_metrics = ContextVar('current_metrics', default=None)
+
+METRICS = (
+    ('requests_total', 'counter', 'Количество запросов'),
+    ('request_seconds_total', 'counter', 'Суммарное время ответа'),
+    ('queries_total', 'counter', 'Количество SQL-запросов'),
+    ('sql_seconds_total', 'counter', 'Суммарное время SQL'),
+    ('serializer_seconds_total', 'counter', 'Суммарное время сериализации'),
+    ('response_bytes_total', 'counter', 'Суммарный размер ответов'),
+    ('n_plus_one_total', 'counter', 'Запросы с повторяющимся SQL'),
+)
+
+
+class RequestMetrics:
+    """Запросы к базе и время сериализации одного HTTP-запроса"""
+    def __init__(self):
+        self.queries = 0
+        self.sql_time = 0.0
+        self.serializer_time = 0.0
+        self.serializer_depth = 0
+        self.signatures = Counter()
+        self.stacks = {}
+
+    def __call__(self, execute, sql, params, many, context):
+        """execute_wrapper: время и сигнатура каждого SQL-запроса"""
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.sql_time += time.perf_counter() - started
+            self.queries += 1
+            self.signatures[sql] += 1
+            if self.signatures[sql] == settings.INSTRUMENTATION_N_PLUS_ONE:
+                self.stacks[sql] = ''.join(traceback.format_list([
+                    frame for frame in traceback.extract_stack()
+                    if str(settings.BASE_DIR) in frame.filename
+                    and __file__ != frame.filename
+                ]))
+
+    def duplicates(self):
+        return {
+            sql: self.signatures[sql] for sql in self.stacks
+        }
+
+
+class MetricsRegistry:
+    """Накопленные по view метрики процесса. У каждого воркера
+    gunicorn свой реестр: /api/metrics/ отдает метрики того воркера,
+    который обработал запрос, и обнуляется при его перезапуске"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = defaultdict(Counter)
+
+    def add(self, labels, **values):
+        with self.lock:
+            self.values[labels].update(values)
+
+    def render(self):
+        """Метрики в текстовом формате Prometheus"""
+        with self.lock:
+            values = {
+                labels: dict(counter)
+                for labels, counter in self.values.items()
+            }
+        lines = []
+        for name, kind, description in METRICS:
+            metric = f'foodgram_{name}'
+            lines.append(f'# HELP {metric} {description}')
+            lines.append(f'# TYPE {metric} {kind}')
+            for labels, counter in sorted(values.items()):
+                label_text = ','.join(
+                    f'{key}="{value}"' for key, value in labels
+                )
+                lines.append(
+                    f'{metric}{{{label_text}}} {counter.get(name, 0)}'
+                )
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+
+class TimedSerializerMixin:
+    """Время to_representation попадает в метрики запроса.
+    Подключается к сериализаторам ответов явно; вложенные сериализаторы
+    и элементы списка внутри внешнего не считаются дважды"""
+
+    def to_representation(self, instance):
+        metrics = current_metrics.get()
+        if metrics is None or metrics.serializer_depth:
+            return super().to_representation(instance)
+        metrics.serializer_depth += 1
+        started = time.perf_counter()
+        try:
+            return super().to_representation(instance)
+        finally:
+            metrics.serializer_time += time.perf_counter() - started
+            metrics.serializer_depth -= 1
+
+
+def get_view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unresolved'
+    return match.view_name or match.route or match._func_path
+
+
+class InstrumentationMiddleware:
+    """Метрики по view: количество и время SQL, время сериализации,
+    размер ответа. Отдает их в Server-Timing и в /api/metrics/,
+    повторяющиеся SQL-запросы пишет в лог вместе со стеком"""
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        metrics = RequestMetrics()
+        token = current_metrics.set(metrics)
+        started = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(metrics))
+                response = self.get_response(request)
+        finally:
+            current_metrics.reset(token)
+        total_time = time.perf_counter() - started
+        view = get_view_name(request)
+        size = 0 if response.streaming else len(response.content)
+        duplicates = metrics.duplicates()
+        registry.add(
+            (
+                ('view', view),
+                ('method', request.method),
+                ('status', str(response.status_code)),
+            ),
+            requests_total=1,
+            request_seconds_total=total_time,
+            queries_total=metrics.queries,
+            sql_seconds_total=metrics.sql_time,
+            serializer_seconds_total=metrics.serializer_time,
+            response_bytes_total=size,
+            n_plus_one_total=1 if duplicates else 0,
+        )
+        for sql, count in duplicates.items():
+            logger.warning(
+                '%s %s: SQL повторен %s раз: %s\n%s',
+                request.method,
+                view,
+                count,
+                sql,
+                metrics.stacks[sql]
+            )
+        response['Server-Timing'] = ', '.join((
+            f'db;dur={metrics.sql_time * 1000:.1f};'
+            f'desc="{metrics.queries} queries"',
+            f'serializer;dur={metrics.serializer_time * 1000:.1f}',
+            f'total;dur={total_time * 1000:.1f}',
+        ))
+        return response
@@ -0,0 +1,113 @@
+from django.conf import settings
+from django.test import TestCase, override_settings
+from rest_framework.serializers import BaseSerializer
+from rest_framework.test import APIClient
+
+from food.models import Recipe
+from users.models import User
+
+from .instrumentation import registry
+
+INSTRUMENTED = override_settings(
+    INSTRUMENTATION=True,
+    MIDDLEWARE=[
+        'core.instrumentation.InstrumentationMiddleware',
+        *settings.MIDDLEWARE,
+    ]
+)
+
+
+@INSTRUMENTED
+class InstrumentationTest(TestCase):
+    """Метрики запросов и время сериализации"""
+
+    @classmethod
+    def setUpTestData(cls):
+        author = User.objects.create_user(
+            username='author',
+            email='author@example.com',
+            password='password'
+        )
+        Recipe.objects.bulk_create(
+            Recipe(
+                author=author,
+                name=f'Рецепт {number}',
+                text='Описание',
+                cooking_time=10
+            )
+            for number in range(3)
+        )
+
+    def setUp(self):
+        registry.values.clear()
+
+    def get_values(self, view):
+        return {
+            labels: counter
+            for labels, counter in registry.values.items()
+            if ('view', view) in labels
+        }
+
+    def test_serializer_time(self):
+        data = BaseSerializer.data
+        response = APIClient().get('/api/recipes/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('serializer;dur=', response['Server-Timing'])
+        self.assertIs(BaseSerializer.data, data)
+        (counter, ) = self.get_values('recipe-list').values()
+        self.assertGreater(counter['serializer_seconds_total'], 0)
+        self.assertLess(
+            counter['serializer_seconds_total'],
+            counter['request_seconds_total']
+        )
+        self.assertGreater(counter['queries_total'], 0)
+
+
+@INSTRUMENTED
+class MetricsViewTest(TestCase):
+    """Доступ к /api/metrics/"""
+    url = '/api/metrics/'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username='user',
+            email='user@example.com',
+            password='password'
+        )
+        cls.staff = User.objects.create_user(
+            username='staff',
+            email='staff@example.com',
+            password='password',
+            is_staff=True
+        )
+
+    @override_settings(INSTRUMENTATION=False)
+    def test_disabled(self):
+        self.client.force_login(self.staff)
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+    def test_without_token(self):
+        """Без токена в настройках метрики только для сотрудников"""
+        self.assertEqual(self.client.get(self.url).status_code, 401)
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(self.url).status_code, 401)
+        self.client.force_login(self.staff)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(
+            b'# TYPE foodgram_requests_total counter',
+            response.content
+        )
+
+    @override_settings(INSTRUMENTATION_METRICS_TOKEN='secret')
+    def test_token(self):
+        for header, status in (
+            ('', 401),
+            ('Bearer wrong', 401),
+            ('Bearer secret', 200),
+        ):
+            response = self.client.get(self.url, HTTP_AUTHORIZATION=header)
+            self.assertEqual(response.status_code, status, header)
+        self.client.force_login(self.staff)
+        self.assertEqual(self.client.get(self.url).status_code, 200)
@@ -1,5 +1,30 @@
+from django.conf import settings
+from django.http import Http404, HttpResponse
 from django.shortcuts import render
+from django.utils.crypto import constant_time_compare
+
+from .instrumentation import registry
 
 
 def page_not_found(request, exception):
     return render(request, 'core/404.html', {'path': request.path}, status=404)
+
+
+def metrics(request):
+    """Метрики в формате Prometheus, если инструментирование включено.
+    Доступны по Bearer-токену из настроек или сотруднику в админке;
+    без токена в настройках - только сотруднику. Метрики свои
+    у каждого воркера, суммирует их Prometheus"""
+    if not settings.INSTRUMENTATION:
+        raise Http404
+    token = settings.INSTRUMENTATION_METRICS_TOKEN
+    has_token = bool(token) and constant_time_compare(
+        request.headers.get('Authorization', ''),
+        f'Bearer {token}'
+    )
+    if not (has_token or request.user.is_staff):
+        return HttpResponse(status=401)
+    return HttpResponse(
+        registry.render(),
+        content_type='text/plain; version=0.0.4; charset=utf-8'
+    )
@@ -1,28 +1,92 @@
 from django.contrib import admin
+from django.db import transaction
 
-from .models import (Favorite, Ingredient, Recipe, RecipesIngredient,
-                     ShoppingCart, Tag)
+from . import cook_index, recipe_cache, shopping_list
+from .models import (Favorite, ImageJob, Ingredient, Recipe, RecipesIngredient,
+                     ShoppingCart, ShoppingListIngredient, SimilarRecipe, Tag)
+
+
+class ReadOnlyAdmin(admin.ModelAdmin):
+    """Только просмотр: счетчики рецептов и суммы списков покупок
+    пересчитываются в API, правка мимо него их бы рассогласовала"""
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
 
 
 class RecipeIngredientInline(admin.TabularInline):
     model = RecipesIngredient
-    min_num = 1
+    extra = 0
+    can_delete = False
+    readonly_fields = ('ingredient', 'amount')
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
 
 
 class RecipeAdmin(admin.ModelAdmin):
-    list_display = ('name', 'author', 'favorite_count', 'created_at')
+    list_display = (
+        'name',
+        'author',
+        'favorite_count',
+        'cart_count',
+        'trending_score',
+        'created_at'
+    )
     list_filter = ('name', 'author', 'tags', )
     inlines = (RecipeIngredientInline, )
 
+    def get_deleted_objects(self, objs, request):
+        """Связи удаляются каскадом вместе с рецептом, прав на них
+        не нужно: списки покупок пересчитывает delete_model"""
+        deleted_objects, model_count, perms_needed, protected = (
+            super().get_deleted_objects(objs, request)
+        )
+        relations = {
+            str(model._meta.verbose_name)
+            for model in (RecipesIngredient, ShoppingCart, Favorite)
+        }
+        perms_needed -= relations
+        return deleted_objects, model_count, perms_needed, protected
+
+    def delete_model(self, request, obj):
+        """Удаление как в API: рецепт вычитается из списков покупок"""
+        with transaction.atomic():
+            shopping_list.recipe_deleted(obj)
+            recipe_cache.recipe_changed(obj.pk)
+            cook_index.recipe_deleted(obj.pk)
+            super().delete_model(request, obj)
+
+    def delete_queryset(self, request, queryset):
+        for obj in queryset:
+            self.delete_model(request, obj)
+
 
 class IngredientAdmin(admin.ModelAdmin):
     list_display = ('name', 'measurement_unit', )
     list_filter = ('name', )
 
 
+class ImageJobAdmin(admin.ModelAdmin):
+    list_display = ('recipe', 'status', 'attempts', 'updated_at')
+    list_filter = ('status', )
+
+
 admin.site.register(Recipe, RecipeAdmin)
 admin.site.register(Ingredient, IngredientAdmin)
 admin.site.register(Tag)
-admin.site.register(RecipesIngredient)
-admin.site.register(ShoppingCart)
-admin.site.register(Favorite)
+admin.site.register(RecipesIngredient, ReadOnlyAdmin)
+admin.site.register(ShoppingCart, ReadOnlyAdmin)
+admin.site.register(Favorite, ReadOnlyAdmin)
+admin.site.register(ShoppingListIngredient, ReadOnlyAdmin)
+admin.site.register(ImageJob, ImageJobAdmin)
+admin.site.register(SimilarRecipe)
@@ -0,0 +1,112 @@
+import hashlib
+import time
+import uuid
+
+from django.core.cache import DEFAULT_CACHE_ALIAS, cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.utils.http import http_date, parse_http_date_safe
+from rest_framework import status
+from rest_framework.response import Response
+
+PAYLOAD_TIMEOUT = 60 * 60 * 24
+
+
+def version_key(scope):
+    return f'api_version:{scope}'
+
+
+def is_process_local():
+    """Кеш живет в памяти процесса: версии, сдвинутые другим процессом,
+    веб-серверу не видны"""
+    return isinstance(caches[DEFAULT_CACHE_ALIAS], LocMemCache)
+
+
+def get_version(scope):
+    """Текущая версия данных scope и время ее появления"""
+    key = version_key(scope)
+    value = cache.get(key)
+    if value is None:
+        cache.add(key, (uuid.uuid4().hex, int(time.time())), None)
+        value = cache.get(key)
+    return value
+
+
+def get_versions(scopes):
+    """Версии нескольких scope одним обращением к кешу"""
+    keys = {version_key(scope): scope for scope in scopes}
+    values = cache.get_many(keys)
+    for key, scope in keys.items():
+        if key not in values:
+            values[key] = get_version(scope)
+    return {scope: values[key][0] for key, scope in keys.items()}
+
+
+def bump_version(scope):
+    """Данные scope изменились: старые ответы больше не используются"""
+    value = (uuid.uuid4().hex, int(time.time()))
+    cache.set(version_key(scope), value, None)
+    return value
+
+
+def get_versioned(scope, name, build):
+    """Значение build(), закешированное до смены версии scope"""
+    version, _ = get_version(scope)
+    key = f'api_value:{scope}:{version}:{name}'
+    value = cache.get(key)
+    if value is None:
+        value = build()
+        cache.set(key, value, PAYLOAD_TIMEOUT)
+    return value
+
+
+class VersionedCacheMixin:
+    """Кеширует list/retrieve до смены версии cache_scope
+    и отвечает 304 по If-None-Match/If-Modified-Since"""
+    cache_scope = None
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(
+            super().retrieve,
+            request,
+            *args,
+            **kwargs
+        )
+
+    def cached_response(self, handler, request, *args, **kwargs):
+        version, modified = get_version(self.cache_scope)
+        path = request.get_full_path()
+        digest = hashlib.md5(f'{version}:{path}'.encode()).hexdigest()
+        etag = f'"{digest}"'
+        headers = {
+            'ETag': etag,
+            'Last-Modified': http_date(modified),
+            'Cache-Control': 'public, no-cache',
+        }
+        if_none_match = request.headers.get('If-None-Match')
+        if_modified_since = parse_http_date_safe(
+            request.headers.get('If-Modified-Since', '')
+        )
+        if if_none_match is not None:
+            not_modified = etag in [
+                tag.strip() for tag in if_none_match.split(',')
+            ]
+        else:
+            not_modified = (
+                if_modified_since is not None
+                and if_modified_since >= modified
+            )
+        if not_modified:
+            return Response(status=status.HTTP_304_NOT_MODIFIED,
+                            headers=headers)
+        key = f'api_payload:{self.cache_scope}:{digest}'
+        data = cache.get(key)
+        if data is None:
+            response = handler(request, *args, **kwargs)
+            if response.status_code != status.HTTP_200_OK:
+                return response
+            data = response.data
+            cache.set(key, data, PAYLOAD_TIMEOUT)
+        return Response(data, headers=headers)
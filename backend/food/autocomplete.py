@@ -0,0 +1,88 @@
+import time
+from bisect import bisect_left, bisect_right
+
+from . import api_cache
+from .models import Ingredient
+
+AUTOCOMPLETE_LIMIT = 10
+MAX_AUTOCOMPLETE_LIMIT = 50
+INDEX_TTL = 300
+
+
+class IngredientIndex:
+    """Отсортированный по названию список ингредиентов в памяти процесса"""
+    def __init__(self, ingredients):
+        rows = sorted(
+            (
+                (name.lower(), {
+                    'id': pk,
+                    'name': name,
+                    'measurement_unit': measurement_unit,
+                })
+                for pk, name, measurement_unit in ingredients
+            ),
+            key=lambda row: row[0]
+        )
+        self.keys = [key for key, _ in rows]
+        self.items = [item for _, item in rows]
+        self.offsets = []
+        offset = 0
+        for key in self.keys:
+            self.offsets.append(offset)
+            offset += len(key) + 1
+        self.blob = '\n'.join(self.keys)
+
+    def search(self, query, limit=AUTOCOMPLETE_LIMIT):
+        """Сначала совпадения по началу названия, затем по вхождению"""
+        query = query.lower().replace('\n', ' ')
+        start = bisect_left(self.keys, query)
+        end = start
+        while (
+            end < len(self.keys)
+            and end - start < limit
+            and self.keys[end].startswith(query)
+        ):
+            end += 1
+        result = self.items[start:end]
+        if len(result) >= limit:
+            return result
+        found = self.blob.find(query)
+        while found != -1 and len(result) < limit:
+            position = bisect_right(self.offsets, found) - 1
+            if found != self.offsets[position]:
+                result.append(self.items[position])
+            if position + 1 == len(self.offsets):
+                break
+            found = self.blob.find(query, self.offsets[position + 1])
+        return result
+
+
+_index = None
+_index_version = None
+_built_at = 0
+
+
+def get_index():
+    """Индекс строится лениво и перестраивается при смене версии
+    ингредиентов в общем кеше, но живет не дольше INDEX_TTL секунд"""
+    global _index, _index_version, _built_at
+    version, _ = api_cache.get_version('ingredients')
+    if (
+        _index is None
+        or _index_version != version
+        or time.monotonic() - _built_at > INDEX_TTL
+    ):
+        _index = IngredientIndex(
+            Ingredient.objects.values_list(
+                'pk', 'name', 'measurement_unit'
+            ).order_by().iterator()
+        )
+        _index_version = version
+        _built_at = time.monotonic()
+    return _index
+
+
+def invalidate():
+    """Сброс индекса после изменения ингредиентов"""
+    global _index
+    _index = None
@@ -0,0 +1,551 @@
+"""Бенчмарки: python manage.py test food.benchmarks
+Данные генерируются в тестовой базе, результаты печатаются в stdout"""
+import base64
+import os
+import random
+import resource
+import statistics
+import string
+import time
+from datetime import timedelta
+from unittest import mock
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.files.base import ContentFile
+from django.db.models import Count, F, Q
+from django.test import RequestFactory, TestCase
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+from rest_framework.test import APIClient
+
+from users.models import Subscribe, User
+
+from . import api_cache, similarity
+from .autocomplete import IngredientIndex
+from .cook_index import COOK_LIMIT, CookIndex
+from .filters import IngredientFilter, RecipeFilter
+from .models import Ingredient, Recipe, RecipesIngredient, RecipeTag, Tag
+from .search import USE_POSTGRES_SEARCH, search_recipes, update_search_vectors
+from .serializers import Base64ImageField
+
+ALPHABET = 'абвгдеежзийклмнопрстуфхцчшщыэюя'
+
+
+def random_word(generator, length):
+    return ''.join(generator.choice(ALPHABET) for _ in range(length))
+
+
+def create_corpus(generator, recipes_count, authors_count=100,
+                  tags_count=20, ingredients_count=2000):
+    """Авторы, тэги, ингредиенты и рецепты, у каждого рецепта 1-3 тэга
+    и 5-10 ингредиентов; даты создания идут с шагом в минуту"""
+    User.objects.bulk_create(
+        User(username=f'author{number}', email=f'author{number}@example.com')
+        for number in range(authors_count)
+    )
+    Tag.objects.bulk_create(
+        Tag(name=f'Тэг {number}', color=f'#{number:06x}', slug=f'tag{number}')
+        for number in range(tags_count)
+    )
+    Ingredient.objects.bulk_create(
+        Ingredient(
+            name=f'{random_word(generator, 8)} {number}',
+            measurement_unit='г'
+        )
+        for number in range(ingredients_count)
+    )
+    author_ids = list(User.objects.values_list('pk', flat=True))
+    tag_ids = list(Tag.objects.values_list('pk', flat=True))
+    ingredient_ids = list(Ingredient.objects.values_list('pk', flat=True))
+    Recipe.objects.bulk_create(
+        (
+            Recipe(
+                author_id=generator.choice(author_ids),
+                name=f'{random_word(generator, 6)} {number}',
+                text=' '.join(
+                    random_word(generator, generator.randint(3, 9))
+                    for _ in range(20)
+                ),
+                cooking_time=generator.randint(5, 120)
+            )
+            for number in range(recipes_count)
+        ),
+        batch_size=5000
+    )
+    recipe_ids = list(Recipe.objects.order_by('pk').values_list(
+        'pk',
+        flat=True
+    ))
+    started = timezone.now()
+    for start in range(0, len(recipe_ids), 1000):
+        Recipe.objects.filter(pk__in=recipe_ids[start:start + 1000]).update(
+            created_at=started - timedelta(minutes=len(recipe_ids) - start)
+        )
+    RecipeTag.objects.bulk_create(
+        (
+            RecipeTag(recipe_id=recipe_id, tag_id=tag_id)
+            for recipe_id in recipe_ids
+            for tag_id in generator.sample(tag_ids, generator.randint(1, 3))
+        ),
+        batch_size=5000
+    )
+    RecipesIngredient.objects.bulk_create(
+        (
+            RecipesIngredient(
+                recipe_id=recipe_id,
+                ingredient_id=ingredient_id,
+                amount=generator.randint(1, 500)
+            )
+            for recipe_id in recipe_ids
+            for ingredient_id in generator.sample(
+                ingredient_ids,
+                generator.randint(5, 10)
+            )
+        ),
+        batch_size=5000
+    )
+    return recipe_ids
+
+
+def measure(function, *args):
+    """Время вызова в миллисекундах"""
+    started = time.perf_counter()
+    function(*args)
+    return (time.perf_counter() - started) * 1000
+
+
+def percentiles(timings):
+    """p50 и p99 в миллисекундах"""
+    points = statistics.quantiles(timings, n=100, method='inclusive')
+    return points[49], points[98]
+
+
+def current_rss():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize()
+
+
+def peak_rss(function, *args):
+    """Прирост пикового RSS за вызов в мегабайтах (Linux).
+    Вызов идет в дочернем процессе: его пик начинается с RSS на момент
+    fork, поэтому предыдущие замеры не влияют на следующие"""
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        before = current_rss()
+        function(*args)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        os.write(write, str(max(peak - before, 0)).encode())
+        os._exit(0)
+    os.close(write)
+    with os.fdopen(read) as pipe:
+        result = int(pipe.read())
+    os.waitpid(pid, 0)
+    return result / 2 ** 20
+
+
+def report(title, header, rows):
+    print(f'\n{title}')
+    print('  '.join(f'{column:>12}' for column in header))
+    for row in rows:
+        print('  '.join(
+            f'{value:>12.2f}' if isinstance(value, float) else f'{value:>12}'
+            for value in row
+        ))
+
+
+class AutocompleteBenchmark(TestCase):
+    """Подсказки ингредиентов на каждое нажатие клавиши"""
+    sizes = (2000, 200000)
+    typed = 50
+
+    def create_ingredients(self, generator, count):
+        Ingredient.objects.bulk_create(
+            (
+                Ingredient(
+                    name=' '.join(
+                        random_word(generator, generator.randint(3, 10))
+                        for _ in range(generator.randint(1, 3))
+                    ),
+                    measurement_unit=generator.choice(('г', 'мл', 'шт')),
+                )
+                for _ in range(count)
+            ),
+            batch_size=5000,
+            ignore_conflicts=True
+        )
+
+    def keystrokes(self, generator, names):
+        """Префиксы, которые уходят на сервер при наборе названий"""
+        for name in generator.sample(names, self.typed):
+            for end in range(1, len(name) + 1):
+                yield name[:end]
+        for _ in range(self.typed):
+            yield random_word(generator, 3) + generator.choice(
+                string.digits
+            )
+
+    def test_keystrokes(self):
+        generator = random.Random(5)
+        rows = []
+        created = 0
+        for size in self.sizes:
+            self.create_ingredients(generator, size - created)
+            created = size
+            ingredients = list(
+                Ingredient.objects.values_list(
+                    'pk', 'name', 'measurement_unit'
+                ).order_by()
+            )
+            build = measure(IngredientIndex, ingredients)
+            index = IngredientIndex(ingredients)
+            prefixes = list(self.keystrokes(
+                generator,
+                [name for _, name, _ in ingredients]
+            ))
+            in_memory = [measure(index.search, prefix) for prefix in prefixes]
+            queryset = Ingredient.objects.all()
+            database = [
+                measure(
+                    lambda value: list(IngredientFilter(
+                        {'name': value},
+                        queryset=queryset
+                    ).qs[:10]),
+                    prefix
+                )
+                for prefix in prefixes
+            ]
+            rows.append((
+                len(ingredients),
+                len(prefixes),
+                build,
+                *percentiles(in_memory),
+                *percentiles(database),
+            ))
+        report(
+            'Подсказки ингредиентов, мс на нажатие',
+            ('ingredients', 'keystrokes', 'index build', 'index p50',
+             'index p99', 'db p50', 'db p99'),
+            rows
+        )
+
+
+def decode_whole(data):
+    """Декодирование картинки до Base64ImageField с потоковым разбором"""
+    format, imgstr = data.split(';base64,')
+    ext = format.split('/')[-1]
+    return ContentFile(base64.b64decode(imgstr), name='temp.' + ext)
+
+
+def decode_chunked(data):
+    try:
+        Base64ImageField().decode(data).close()
+    except ValidationError:
+        pass
+
+
+class ImageDecodeBenchmark(TestCase):
+    """Пиковая память на декодирование загруженной картинки"""
+    sizes = (1, 5, 20)
+
+    def test_peak_rss(self):
+        rows = []
+        for size in self.sizes:
+            data = 'data:image/png;base64,' + base64.b64encode(
+                os.urandom(size * 2 ** 20)
+            ).decode()
+            rows.append((
+                size,
+                len(data) / 2 ** 20,
+                peak_rss(decode_whole, data),
+                peak_rss(decode_chunked, data),
+            ))
+            del data
+        report(
+            'Декодирование base64, прирост пикового RSS, МБ',
+            ('image MB', 'payload MB', 'before', 'after'),
+            rows
+        )
+
+
+def filter_tags_distinct(queryset, slugs):
+    """Фильтр по тэгам до подзапросов: OR по join и DISTINCT"""
+    condition = Q()
+    for slug in slugs:
+        condition |= Q(tags__slug=slug)
+    return queryset.filter(condition).distinct()
+
+
+def first_page(queryset):
+    """Что делает лента: COUNT и первая страница"""
+    queryset.count()
+    list(queryset.order_by('-created_at', '-id')[:10])
+
+
+class TagFilterBenchmark(TestCase):
+    """Лента с фильтром по 1-10 тэгам на 100k рецептов"""
+    recipes_count = 100000
+    repeat = 5
+
+    @classmethod
+    def setUpTestData(cls):
+        create_corpus(random.Random(12), cls.recipes_count)
+
+    def timing(self, function, *args):
+        return statistics.median(
+            measure(function, *args) for _ in range(self.repeat)
+        )
+
+    def test_tags(self):
+        request = RequestFactory().get('/api/recipes/')
+        request.user = AnonymousUser()
+        request.GET = request.GET.copy()
+        queryset = Recipe.objects.all()
+        rows = []
+        for count in range(1, 11):
+            slugs = [f'tag{number}' for number in range(count)]
+            results = []
+            for match in ('any', 'all'):
+                request.GET['tags_match'] = match
+                request.GET.setlist('tags', slugs)
+                results.append(self.timing(
+                    first_page,
+                    RecipeFilter(
+                        request.GET,
+                        queryset=queryset,
+                        request=request
+                    ).qs
+                ))
+            rows.append((
+                count,
+                self.timing(
+                    first_page,
+                    filter_tags_distinct(queryset, slugs)
+                ),
+                *results,
+            ))
+        report(
+            f'Фильтр по тэгам, {self.recipes_count} рецептов, '
+            f'мс на COUNT и первую страницу (медиана из {self.repeat})',
+            ('tags', 'distinct', 'exists any', 'all'),
+            rows
+        )
+
+
+class SearchBenchmark(TestCase):
+    """Полнотекстовый поиск по 100k рецептов"""
+    recipes_count = 100000
+    queries = 40
+
+    @classmethod
+    def setUpTestData(cls):
+        create_corpus(random.Random(15), cls.recipes_count)
+        cls.vectors_time = measure(
+            update_search_vectors,
+            Recipe.objects.all()
+        )
+
+    def get_queries(self, generator):
+        """Слова из названий, описаний и ингредиентов, по одному и парами"""
+        words = [
+            word
+            for name, text in Recipe.objects.values_list(
+                'name', 'text'
+            ).order_by('?')[:self.queries]
+            for word in (name.split()[0], generator.choice(text.split()))
+        ] + [
+            name.split()[0] for name in Ingredient.objects.values_list(
+                'name', flat=True
+            ).order_by('?')[:self.queries // 2]
+        ]
+        return words + [
+            ' '.join(generator.sample(words, 2))
+            for _ in range(self.queries // 2)
+        ]
+
+    def test_search(self):
+        queries = self.get_queries(random.Random(15))
+        queryset = Recipe.objects.all()
+        rows = []
+        for words in (1, 2):
+            timings = [
+                measure(first_page, search_recipes(queryset, query))
+                for query in queries
+                if len(query.split()) == words
+            ]
+            rows.append((words, len(timings), *percentiles(timings)))
+        report(
+            f'Поиск, {self.recipes_count} рецептов, '
+            f'{"tsvector" if USE_POSTGRES_SEARCH else "icontains"}, '
+            f'векторы {self.vectors_time:.0f} мс, '
+            f'мс на COUNT и первую страницу',
+            ('words', 'queries', 'p50', 'p99'),
+            rows
+        )
+
+
+def top_sql(ingredient_ids, limit=COOK_LIMIT):
+    """Тот же подбор запросом: GROUP BY по всем ингредиентам рецептов"""
+    return list(Recipe.objects.annotate(
+        matched=Count(
+            'recipe_ingredients',
+            filter=Q(recipe_ingredients__ingredient_id__in=ingredient_ids)
+        ),
+        missing=Count('recipe_ingredients') - F('matched')
+    ).filter(matched__gt=0).order_by(
+        '-matched',
+        'missing',
+        '-id'
+    ).values_list('id', 'matched', 'missing')[:limit])
+
+
+class CookBenchmark(TestCase):
+    """Что приготовить из имеющихся ингредиентов на 100k рецептов"""
+    recipes_count = 100000
+    pantries = 20
+    updates = 1000
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.recipe_ids = create_corpus(random.Random(16), cls.recipes_count)
+
+    def test_top(self):
+        generator = random.Random(16)
+        pairs = list(RecipesIngredient.objects.values_list(
+            'recipe_id',
+            'ingredient_id'
+        ).order_by())
+        build = measure(CookIndex, pairs)
+        index = CookIndex(pairs)
+        ingredient_ids = list(Ingredient.objects.values_list('pk', flat=True))
+        rows = []
+        for size in (5, 10, 20):
+            pantries = [
+                generator.sample(ingredient_ids, size)
+                for _ in range(self.pantries)
+            ]
+            self.assertEqual(index.top(pantries[0]), top_sql(pantries[0]))
+            in_memory = [measure(index.top, pantry) for pantry in pantries]
+            database = [measure(top_sql, pantry) for pantry in pantries]
+            rows.append((
+                size,
+                *percentiles(in_memory),
+                *percentiles(database),
+            ))
+        update = statistics.mean(
+            measure(
+                index.set_recipe,
+                generator.choice(self.recipe_ids),
+                generator.sample(ingredient_ids, generator.randint(5, 10))
+            )
+            for _ in range(self.updates)
+        )
+        report(
+            f'Что приготовить, {self.recipes_count} рецептов, '
+            f'{len(pairs)} связей, сборка индекса {build:.0f} мс, '
+            f'правка рецепта {update:.3f} мс, мс на запрос',
+            ('pantry', 'index p50', 'index p99', 'sql p50', 'sql p99'),
+            rows
+        )
+
+
+class FeedBenchmark(TestCase):
+    """Лента подписок на 100k рецептов от 10k авторов"""
+    recipes_count = 100000
+    authors_count = 10000
+    following = (10, 1000, 10000)
+    repeat = 20
+
+    @classmethod
+    def setUpTestData(cls):
+        generator = random.Random(22)
+        create_corpus(
+            generator,
+            cls.recipes_count,
+            authors_count=cls.authors_count
+        )
+        author_ids = list(User.objects.values_list('pk', flat=True))
+        cls.followers = []
+        for count in cls.following:
+            follower = User.objects.create(
+                username=f'follower{count}',
+                email=f'follower{count}@example.com'
+            )
+            Subscribe.objects.bulk_create(
+                (
+                    Subscribe(follower=follower, follow_id=author_id)
+                    for author_id in generator.sample(author_ids, count)
+                ),
+                batch_size=5000
+            )
+            cls.followers.append(follower)
+
+    def test_feed(self):
+        rows = []
+        for count, follower in zip(self.following, self.followers):
+            client = APIClient()
+            client.force_authenticate(follower)
+            url = '/api/recipes/feed/?limit=10'
+            next_url = client.get(url).json()['next']
+            cold = []
+            for _ in range(self.repeat):
+                api_cache.bump_version(f'feed:{follower.pk}')
+                cold.append(measure(client.get, url))
+            cached = [measure(client.get, url) for _ in range(self.repeat)]
+            next_page = [
+                measure(client.get, next_url) for _ in range(self.repeat)
+            ]
+            rows.append((
+                count,
+                *percentiles(cold),
+                *percentiles(cached),
+                *percentiles(next_page),
+            ))
+        report(
+            f'Лента, {self.recipes_count} рецептов, '
+            f'{self.authors_count} авторов, limit=10, мс на запрос',
+            ('following', 'cold p50', 'cold p99', 'cached p50',
+             'cached p99', 'next p50', 'next p99'),
+            rows
+        )
+
+
+class SimilarityBenchmark(TestCase):
+    """Пересчет похожих рецептов на 100k рецептов: весь и после правок.
+    Блокировки держатся только на время записи блока, его время и важно"""
+    recipes_count = 100000
+    changed = (10, 100, 1000)
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.recipe_ids = create_corpus(random.Random(24), cls.recipes_count)
+
+    def rebuild(self, full):
+        """Время пересчета и записи каждого блока в миллисекундах"""
+        writes = []
+        save_neighbours = similarity.save_neighbours
+
+        def timed(*args):
+            writes.append(measure(save_neighbours, *args))
+
+        with mock.patch.object(similarity, 'save_neighbours', timed):
+            started = time.perf_counter()
+            rebuilt = similarity.rebuild(full=full)
+        total = (time.perf_counter() - started) * 1000
+        return rebuilt, total, statistics.median(writes), max(writes)
+
+    def test_rebuild(self):
+        generator = random.Random(24)
+        rows = [('full', *self.rebuild(True))]
+        for count in self.changed:
+            Recipe.objects.filter(
+                pk__in=generator.sample(self.recipe_ids, count)
+            ).update(similarity_outdated=True)
+            rows.append((count, *self.rebuild(False)))
+        report(
+            f'Похожие рецепты, {self.recipes_count} рецептов, '
+            f'блок {similarity.BLOCK_SIZE}, мс',
+            ('changed', 'rebuilt', 'total', 'write p50', 'write max'),
+            rows
+        )
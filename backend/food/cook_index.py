@@ -0,0 +1,135 @@
+import heapq
+import threading
+import time
+from array import array
+from bisect import bisect_left, insort
+from collections import Counter
+from itertools import chain
+
+from django.db import transaction
+
+from . import api_cache
+from .models import RecipesIngredient
+
+SCOPE = 'recipe_ingredients'
+REBUILD_INTERVAL = 60
+COOK_LIMIT = 20
+MAX_COOK_LIMIT = 100
+
+
+class CookIndex:
+    """Инвертированный индекс ингредиент -> отсортированные id рецептов"""
+    def __init__(self, pairs=()):
+        self.postings = {}
+        self.recipes = {}
+        for recipe_id, ingredient_id in pairs:
+            self.recipes.setdefault(recipe_id, []).append(ingredient_id)
+            self.postings.setdefault(
+                ingredient_id,
+                array('q')
+            ).append(recipe_id)
+        for recipe_ids in self.postings.values():
+            recipe_ids[:] = array('q', sorted(recipe_ids))
+
+    def remove_recipe(self, recipe_id):
+        for ingredient_id in self.recipes.pop(recipe_id, ()):
+            recipe_ids = self.postings[ingredient_id]
+            position = bisect_left(recipe_ids, recipe_id)
+            if (
+                position < len(recipe_ids)
+                and recipe_ids[position] == recipe_id
+            ):
+                recipe_ids.pop(position)
+
+    def set_recipe(self, recipe_id, ingredient_ids):
+        self.remove_recipe(recipe_id)
+        self.recipes[recipe_id] = list(ingredient_ids)
+        for ingredient_id in ingredient_ids:
+            insort(
+                self.postings.setdefault(ingredient_id, array('q')),
+                recipe_id
+            )
+
+    def top(self, ingredient_ids, limit=COOK_LIMIT):
+        """(recipe_id, совпало, не хватает): больше совпадений,
+        затем меньше недостающих, затем новее"""
+        matched = Counter(chain.from_iterable(
+            self.postings.get(ingredient_id, ())
+            for ingredient_id in set(ingredient_ids)
+        ))
+        if not matched:
+            return []
+        threshold = heapq.nlargest(limit, matched.values())[-1]
+        best = sorted(
+            (
+                (recipe_id, count) for recipe_id, count in matched.items()
+                if count >= threshold
+            ),
+            key=lambda item: (
+                -item[1],
+                len(self.recipes[item[0]]) - item[1],
+                -item[0]
+            )
+        )[:limit]
+        return [
+            (recipe_id, count, len(self.recipes[recipe_id]) - count)
+            for recipe_id, count in best
+        ]
+
+
+_index = None
+_index_version = None
+_built_at = 0
+_lock = threading.Lock()
+
+
+def get_index():
+    """Индекс процесса. Чужие изменения (смена версии) подхватываются
+    полной пересборкой не чаще раза в REBUILD_INTERVAL секунд"""
+    global _index, _index_version, _built_at
+    version, _ = api_cache.get_version(SCOPE)
+    stale = _index_version != version and (
+        time.monotonic() - _built_at > REBUILD_INTERVAL
+    )
+    if _index is None or stale:
+        with _lock:
+            if _index is None or stale:
+                pairs = RecipesIngredient.objects.values_list(
+                    'recipe_id',
+                    'ingredient_id'
+                ).order_by().iterator()
+                _index = CookIndex(pairs)
+                _index_version = version
+                _built_at = time.monotonic()
+    return _index
+
+
+def apply_change(recipe_id, ingredient_ids):
+    """Правит индекс своего процесса и объявляет новую версию остальным"""
+    global _index_version
+    previous_version, _ = api_cache.get_version(SCOPE)
+    version, _ = api_cache.bump_version(SCOPE)
+    if _index is None:
+        return
+    with _lock:
+        if ingredient_ids is None:
+            _index.remove_recipe(recipe_id)
+        else:
+            _index.set_recipe(recipe_id, ingredient_ids)
+        if _index_version == previous_version:
+            _index_version = version
+
+
+def recipe_changed(recipe, ingredient_ids=None):
+    """Ингредиенты рецепта записаны; индекс правится после коммита"""
+    if ingredient_ids is None:
+        ingredient_ids = list(
+            recipe.recipe_ingredients.values_list('ingredient_id', flat=True)
+        )
+    transaction.on_commit(
+        lambda: apply_change(recipe.pk, ingredient_ids)
+    )
+
+
+def recipe_deleted(recipe_id):
+    transaction.on_commit(lambda: apply_change(recipe_id, None))
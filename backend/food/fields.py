@@ -0,0 +1,17 @@
+from django.core.files.storage import default_storage
+from rest_framework import serializers
+
+
+class ImageVariantsField(serializers.ReadOnlyField):
+    """Ссылки на уменьшенные копии картинки рецепта"""
+    def to_representation(self, value):
+        if not value:
+            return None
+        request = self.context.get('request')
+        urls = {}
+        for variant, name in value.items():
+            url = default_storage.url(name)
+            if request is not None:
+                url = request.build_absolute_uri(url)
+            urls[variant] = url
+        return urls
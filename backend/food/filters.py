@@ -1,7 +1,43 @@
 import django_filters
-from django.db.models import Q
+from django.db.models import Count, Exists, OuterRef
+from django.db.models.functions import Lower
 
-from .models import Favorite, Ingredient, Recipe, ShoppingCart
+from . import api_cache
+from .models import Favorite, Ingredient, Recipe, RecipeTag, ShoppingCart, Tag
+from .search import search_recipes
+
+RECIPE_ORDERINGS = {
+    'newest': ('-created_at', '-id'),
+    'popular': ('-favorite_count', '-created_at', '-id'),
+    'trending': ('-trending_score', '-created_at', '-id'),
+}
+
+
+def get_recipe_ordering(request):
+    """Поля сортировки рецептов по параметру ordering"""
+    return RECIPE_ORDERINGS.get(
+        request.query_params.get('ordering'),
+        RECIPE_ORDERINGS['newest']
+    )
+
+
+def get_tag_ids():
+    """Словарь slug -> id тэгов из кеша, сбрасывается при изменении тэгов"""
+    return api_cache.get_versioned(
+        'tags',
+        'ids_by_slug',
+        lambda: dict(Tag.objects.values_list('slug', 'id'))
+    )
+
+
+def filter_by_user_relation(queryset, model, user, value):
+    """Коррелированный EXISTS по (user, recipe) вместо списка id в IN"""
+    if user.is_anonymous:
+        return queryset
+    related = Exists(model.objects.filter(user=user, recipe=OuterRef('pk')))
+    if value:
+        return queryset.filter(related)
+    return queryset.filter(~related)
 
 
 class RecipeFilter(django_filters.FilterSet):
@@ -19,61 +55,91 @@ class RecipeFilter(django_filters.FilterSet):
     tags = django_filters.CharFilter(
         method='filter_tags'
     )
+    search = django_filters.CharFilter(
+        method='filter_search'
+    )
+    tags_match = django_filters.ChoiceFilter(
+        choices=(('any', 'any'), ('all', 'all')),
+        method='filter_tags_match'
+    )
+    ordering = django_filters.ChoiceFilter(
+        choices=[(name, name) for name in RECIPE_ORDERINGS],
+        method='filter_ordering'
+    )
 
     def filter_in_favorite(self, queryset, name, value):
         """Фильтр для избранного"""
-        user = self.request.user
-        if user.is_anonymous:
-            return queryset
-        is_favorited = bool(value)
-        favorites = Favorite.objects.filter(user=user)
-        favorite_recipes = [favorite.recipe for favorite in favorites]
-        if is_favorited:
-            return queryset.filter(
-                pk__in=[recipe.pk for recipe in favorite_recipes]
-            )
-        else:
-            return queryset.exclude(
-                pk__in=[recipe.pk for recipe in favorite_recipes]
-            )
+        return filter_by_user_relation(
+            queryset,
+            Favorite,
+            self.request.user,
+            value
+        )
 
     def filter_in_shop_list(self, queryset, name, value):
         """Фильтр для списка покупок"""
-        user = self.request.user
-        if user.is_anonymous:
-            return queryset
-        is_in_shopping_list = bool(value)
-        shop_list = ShoppingCart.objects.filter(user=user)
-        added_recipes = [shop_item.recipe for shop_item in shop_list]
-        if is_in_shopping_list:
-            return queryset.filter(
-                pk__in=[recipe.pk for recipe in added_recipes]
-            )
-        else:
-            return queryset.exclude(
-                pk__in=[recipe.pk for recipe in added_recipes]
-            )
+        return filter_by_user_relation(
+            queryset,
+            ShoppingCart,
+            self.request.user,
+            value
+        )
 
     def filter_tags(self, queryset, name, value):
-        """Фильтр для тэгов"""
-        tags = self.request.GET.getlist('tags')
-        tag_filters = Q()
-        for tag in tags:
-            tag_filters |= Q(tags__slug=tag)
-        return queryset.filter(tag_filters).distinct()
+        """Фильтр для тэгов: любой из (по умолчанию) или все сразу
+        при tags_match=all, подзапросом без DISTINCT по join"""
+        slugs = set(self.request.GET.getlist('tags'))
+        tag_ids = get_tag_ids()
+        ids = {tag_ids[slug] for slug in slugs if slug in tag_ids}
+        match_all = self.request.GET.get('tags_match') == 'all'
+        if not ids or (match_all and len(ids) != len(slugs)):
+            return queryset.none()
+        recipe_tags = RecipeTag.objects.filter(tag_id__in=ids)
+        if not match_all:
+            return queryset.filter(Exists(
+                recipe_tags.filter(recipe_id=OuterRef('pk'))
+            ))
+        return queryset.filter(pk__in=recipe_tags.values(
+            'recipe_id'
+        ).annotate(
+            tags_count=Count('tag_id')
+        ).filter(
+            tags_count=len(ids)
+        ).values('recipe_id'))
+
+    def filter_search(self, queryset, name, value):
+        """Полнотекстовый поиск по названию, описанию и ингредиентам"""
+        return search_recipes(queryset, value)
+
+    def filter_tags_match(self, queryset, name, value):
+        """Режим применяется в filter_tags"""
+        return queryset
+
+    def filter_ordering(self, queryset, name, value):
+        """Сортировка по новизне, популярности или трендам"""
+        return queryset.order_by(*RECIPE_ORDERINGS[value])
 
     class Meta:
         model = Recipe
         fields = (
             'tags',
+            'tags_match',
             'author',
             'is_favorited',
-            'is_in_shopping_cart'
+            'is_in_shopping_cart',
+            'search',
+            'ordering',
         )
 
 
 class IngredientFilter(django_filters.FilterSet):
-    name = django_filters.CharFilter(lookup_expr='istartswith')
+    name = django_filters.CharFilter(method='filter_name')
+
+    def filter_name(self, queryset, name, value):
+        """Поиск по началу названия через индекс по lower(name)"""
+        return queryset.annotate(
+            name_lower=Lower('name')
+        ).filter(name_lower__startswith=value.lower())
 
     class Meta:
         model = Ingredient
@@ -0,0 +1,95 @@
+import io
+import os
+from datetime import timedelta
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from PIL import Image, features
+
+from .models import ImageJob
+
+VARIANTS = {
+    'thumbnail': 160,
+    'card': 480,
+    'full': 1280,
+}
+VARIANTS_DIR = 'food/variants'
+STALE_AFTER = timedelta(minutes=10)
+WEBP_SUPPORTED = features.check('webp')
+
+
+def render_variants(image_name):
+    """Уменьшенные копии картинки рецепта, имена файлов в хранилище.
+    Не обращается к базе, поэтому годится для пула процессов"""
+    stem = os.path.splitext(os.path.basename(image_name))[0]
+    extension, image_format = (
+        ('webp', 'WEBP') if WEBP_SUPPORTED else ('jpg', 'JPEG')
+    )
+    with default_storage.open(image_name, 'rb') as file:
+        source = Image.open(file)
+        source.load()
+    source = source.convert('RGB')
+    names = {}
+    for variant, size in VARIANTS.items():
+        image = source.copy()
+        image.thumbnail((size, size))
+        buffer = io.BytesIO()
+        image.save(buffer, image_format, quality=85)
+        name = f'{VARIANTS_DIR}/{stem}_{variant}.{extension}'
+        if default_storage.exists(name):
+            default_storage.delete(name)
+        names[variant] = default_storage.save(
+            name,
+            ContentFile(buffer.getvalue())
+        )
+    return names
+
+
+def delete_variants(recipe):
+    for name in recipe.image_variants.values():
+        if default_storage.exists(name):
+            default_storage.delete(name)
+
+
+def enqueue(recipe):
+    """Ставит картинку рецепта в очередь на обработку"""
+    delete_variants(recipe)
+    recipe.image_variants = {}
+    recipe.save(update_fields=['image_variants'])
+    if not recipe.image:
+        ImageJob.objects.filter(recipe=recipe).delete()
+        return
+    ImageJob.objects.update_or_create(
+        recipe=recipe,
+        defaults={
+            'image': recipe.image.name,
+            'status': ImageJob.PENDING,
+            'attempts': 0,
+            'error': '',
+        }
+    )
+
+
+def claim_jobs(batch_size):
+    """Забирает пачку задач; параллельные обработчики не пересекаются.
+    Задачи упавшего обработчика возвращаются через STALE_AFTER"""
+    now = timezone.now()
+    with transaction.atomic():
+        jobs = list(
+            ImageJob.objects.select_for_update(
+                skip_locked=True
+            ).filter(
+                Q(status=ImageJob.PENDING)
+                | Q(
+                    status=ImageJob.PROCESSING,
+                    updated_at__lt=now - STALE_AFTER
+                )
+            )[:batch_size]
+        )
+        ImageJob.objects.filter(
+            pk__in=[job.pk for job in jobs]
+        ).update(status=ImageJob.PROCESSING, updated_at=now)
+    return jobs
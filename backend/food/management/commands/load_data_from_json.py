@@ -1,25 +1,114 @@
-# myapp/management/commands/load_data_from_json.py
+import csv
 import json
+import time
+from itertools import islice
+from pathlib import Path
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
 
+from food import api_cache, autocomplete
 from food.models import Ingredient
 
 
+def read_json(file):
+    """Ингредиенты из json: {"ingredients": [...]} или просто список"""
+    data = json.load(file)
+    if isinstance(data, dict):
+        data = data['ingredients']
+    for item in data:
+        yield item['name'], item['measurement_unit']
+
+
+def read_csv(file):
+    """Ингредиенты из csv построчно, строка заголовка пропускается"""
+    for row in csv.reader(file):
+        if not row or row[0].strip().lower() == 'name':
+            continue
+        yield row[0].strip(), row[1].strip()
+
+
+READERS = {
+    '.json': read_json,
+    '.csv': read_csv,
+}
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
 class Command(BaseCommand):
+    help = 'Загружает ингредиенты из json или csv, повторный запуск безопасен'
 
     def add_arguments(self, parser):
         parser.add_argument('json_file', type=str)
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Сколько строк вставлять одним запросом',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Только показать, какие ингредиенты будут добавлены',
+        )
 
     def handle(self, *args, **options):
-        json_file = options['json_file']
+        path = Path(options['json_file'])
+        reader = READERS.get(path.suffix.lower())
+        if reader is None:
+            raise CommandError(
+                f'Неизвестный формат {path.suffix}, нужен json или csv'
+            )
+        with open(path, 'r', encoding='UTF-8', newline='') as file:
+            if options['dry_run']:
+                self.show_diff(reader(file))
+            else:
+                self.load(reader(file), options['batch_size'])
 
-        with open(json_file, 'r', encoding='UTF-8') as file:
-            data = json.load(file)
+    def show_diff(self, rows):
+        existing = set(
+            Ingredient.objects.values_list('name', 'measurement_unit')
+        )
+        new_rows = set(rows) - existing
+        for name, measurement_unit in sorted(new_rows):
+            self.stdout.write(f'+ {name} ({measurement_unit})')
+        self.stdout.write(f'Будет добавлено: {len(new_rows)}')
 
-            for item in data['ingredients']:
-                ingredient = Ingredient(
-                    name=item['name'],
-                    measurement_unit=item['measurement_unit'],
+    def load(self, rows, batch_size):
+        started = time.monotonic()
+        count_before = Ingredient.objects.count()
+        processed = 0
+        with transaction.atomic():
+            for chunk in chunked(rows, batch_size):
+                Ingredient.objects.bulk_create(
+                    [
+                        Ingredient(name=name, measurement_unit=unit)
+                        for name, unit in chunk
+                    ],
+                    ignore_conflicts=True
+                )
+                processed += len(chunk)
+                elapsed = time.monotonic() - started
+                self.stdout.write(
+                    f'Обработано {processed} строк, '
+                    f'{processed / max(elapsed, 1e-6):.0f} строк/с'
                 )
-                ingredient.save()
+        api_cache.bump_version('ingredients')
+        autocomplete.invalidate()
+        if api_cache.is_process_local():
+            self.stderr.write(self.style.WARNING(
+                'Кеш в памяти процесса: запущенный веб-сервер покажет '
+                'новые ингредиенты только после перезапуска'
+            ))
+        added = Ingredient.objects.count() - count_before
+        self.stdout.write(self.style.SUCCESS(
+            f'Добавлено {added}, пропущено {processed - added}'
+        ))
@@ -0,0 +1,93 @@
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.utils import timezone
+
+from food import api_cache, images, recipe_cache
+from food.models import ImageJob, Recipe
+
+MAX_ATTEMPTS = 3
+
+
+class Command(BaseCommand):
+    help = 'Обрабатывает очередь картинок рецептов пулом процессов'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=2,
+            help='Количество процессов для обработки картинок',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=10,
+            help='Сколько задач забирать из очереди за раз',
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=2.0,
+            help='Пауза в секундах, если очередь пуста',
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Обработать очередь и завершиться',
+        )
+
+    def handle(self, *args, **options):
+        if api_cache.is_process_local():
+            self.stderr.write(self.style.WARNING(
+                'Кеш в памяти процесса: запущенный веб-сервер покажет '
+                'новые картинки, когда рецепт изменится или сервер '
+                'перезапустится. Общий кеш задается через '
+                'DJANGO_CACHE_BACKEND и DJANGO_CACHE_LOCATION'
+            ))
+        with ProcessPoolExecutor(max_workers=options['workers']) as pool:
+            while True:
+                close_old_connections()
+                jobs = images.claim_jobs(options['batch_size'])
+                if jobs:
+                    self.process(pool, jobs)
+                    continue
+                if options['once']:
+                    return
+                time.sleep(options['interval'])
+
+    def process(self, pool, jobs):
+        futures = [
+            (job, pool.submit(images.render_variants, job.image))
+            for job in jobs
+        ]
+        for job, future in futures:
+            job_queryset = ImageJob.objects.filter(pk=job.pk, image=job.image)
+            try:
+                variants = future.result()
+            except Exception as error:
+                attempts = job.attempts + 1
+                job_queryset.update(
+                    attempts=attempts,
+                    error=repr(error),
+                    status=(
+                        ImageJob.PENDING if attempts < MAX_ATTEMPTS
+                        else ImageJob.FAILED
+                    ),
+                    updated_at=timezone.now()
+                )
+                self.stderr.write(f'{job.recipe_id}: {error!r}')
+                continue
+            Recipe.objects.filter(
+                pk=job.recipe_id,
+                image=job.image
+            ).update(image_variants=variants)
+            recipe_cache.recipe_changed(job.recipe_id)
+            job_queryset.update(
+                status=ImageJob.DONE,
+                error='',
+                updated_at=timezone.now()
+            )
+            self.stdout.write(f'{job.recipe_id}: {", ".join(variants)}')
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from food import shopping_list
+from food.models import ShoppingListIngredient
+
+
+class Command(BaseCommand):
+    help = 'Пересобирает предрассчитанные списки покупок и сверяет их'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check-only',
+            action='store_true',
+            help='Только сверить таблицу с живым пересчетом',
+        )
+
+    def handle(self, *args, **options):
+        if not options['check_only']:
+            shopping_list.rebuild()
+            self.stdout.write('Списки покупок пересобраны')
+        stored = set(
+            ShoppingListIngredient.objects.values_list(
+                'user_id', 'ingredient_id', 'amount'
+            )
+        )
+        live = set(shopping_list.calculate_totals())
+        if stored != live:
+            raise CommandError(
+                f'Расхождение: {len(stored - live)} лишних строк, '
+                f'{len(live - stored)} недостающих'
+            )
+        self.stdout.write(
+            self.style.SUCCESS(f'Совпадает с пересчетом: {len(live)} строк')
+        )
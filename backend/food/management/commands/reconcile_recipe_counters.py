@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, F, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from food.models import Favorite, Recipe, ShoppingCart
+
+
+def count_subquery(model):
+    """Подзапрос с количеством строк model для рецепта"""
+    return Coalesce(
+        Subquery(
+            model.objects.filter(
+                recipe=OuterRef('pk')
+            ).order_by().values('recipe').annotate(
+                total=Count('pk')
+            ).values('total'),
+            output_field=IntegerField()
+        ),
+        0
+    )
+
+
+class Command(BaseCommand):
+    help = 'Исправляет расхождения счетчиков избранного и списков покупок'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Сколько рецептов обновлять за один запрос',
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        drifted = list(
+            Recipe.objects.annotate(
+                actual_favorites=count_subquery(Favorite),
+                actual_carts=count_subquery(ShoppingCart),
+            ).exclude(
+                favorite_count=F('actual_favorites'),
+                cart_count=F('actual_carts'),
+            ).values_list('pk', flat=True)
+        )
+        with transaction.atomic():
+            for start in range(0, len(drifted), batch_size):
+                Recipe.objects.filter(
+                    pk__in=drifted[start:start + batch_size]
+                ).update(
+                    favorite_count=count_subquery(Favorite),
+                    cart_count=count_subquery(ShoppingCart),
+                )
+        self.stdout.write(
+            self.style.SUCCESS(f'Исправлено рецептов: {len(drifted)}')
+        )
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from food.models import Recipe
+from food.search import update_search_vectors
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает поисковые векторы всех рецептов'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=5000,
+            help='Сколько рецептов обновлять за один запрос',
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        recipe_ids = list(Recipe.objects.values_list('pk', flat=True))
+        for start in range(0, len(recipe_ids), batch_size):
+            update_search_vectors(Recipe.objects.filter(
+                pk__in=recipe_ids[start:start + batch_size]
+            ))
+        self.stdout.write(
+            self.style.SUCCESS(f'Обновлено рецептов: {len(recipe_ids)}')
+        )
@@ -0,0 +1,33 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from food import similarity
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает похожие рецепты для /recipes/{id}/similar/'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--full',
+            action='store_true',
+            help='Пересчитать все рецепты, а не только измененные',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Сколько строк вставлять одним запросом',
+        )
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        rebuilt = similarity.rebuild(
+            full=options['full'],
+            batch_size=options['batch_size']
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f'Пересчитано рецептов: {rebuilt} '
+            f'за {time.monotonic() - started:.2f} с'
+        ))
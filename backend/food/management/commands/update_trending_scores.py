@@ -0,0 +1,54 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from food import trending
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает рейтинг рецептов для сортировки ordering=trending'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--half-life',
+            type=float,
+            default=trending.HALF_LIFE.total_seconds() / 3600,
+            help='За сколько часов вес активности падает вдвое',
+        )
+        parser.add_argument(
+            '--window',
+            type=float,
+            default=trending.WINDOW.days,
+            help='За сколько последних дней учитывается активность',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Сколько рецептов обновлять за один запрос',
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=None,
+            help='Повторять пересчет каждые N секунд',
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            started = time.monotonic()
+            updated = trending.update_scores(
+                batch_size=options['batch_size'],
+                half_life=timedelta(hours=options['half_life']),
+                window=timedelta(days=options['window']),
+            )
+            self.stdout.write(self.style.SUCCESS(
+                f'Обновлено рецептов: {updated} '
+                f'за {time.monotonic() - started:.2f} с'
+            ))
+            if options['interval'] is None:
+                return
+            time.sleep(options['interval'])
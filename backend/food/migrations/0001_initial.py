@@ -0,0 +1,111 @@
+# Generated by Django 3.2.3 on 2026-10-18 17:35
+
+from django.conf import settings
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Ingredient',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=128, verbose_name='Название ингредиента')),
+                ('measurement_unit', models.CharField(max_length=128, verbose_name='Единица измерения')),
+            ],
+            options={
+                'ordering': ('name',),
+                'unique_together': {('name', 'measurement_unit')},
+            },
+        ),
+        migrations.CreateModel(
+            name='Recipe',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=200, verbose_name='Название рецепта')),
+                ('image', models.ImageField(blank=True, null=True, upload_to='food/', verbose_name='Картинка рецепта')),
+                ('text', models.TextField(verbose_name='Описание рецепта')),
+                ('cooking_time', models.PositiveSmallIntegerField(validators=[django.core.validators.MinValueValidator(1), django.core.validators.MaxValueValidator(32000)], verbose_name='Время готовки (мин.)')),
+                ('is_favorited', models.BooleanField(default=False)),
+                ('is_in_shopping_cart', models.BooleanField(default=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('author', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='Автор')),
+            ],
+            options={
+                'ordering': ('-created_at',),
+            },
+        ),
+        migrations.CreateModel(
+            name='Tag',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=128, unique=True, verbose_name='Название тэга')),
+                ('color', models.CharField(max_length=7, unique=True, verbose_name='Цвет тэга в формате HEX')),
+                ('slug', models.SlugField(unique=True, verbose_name='Слаг тэга')),
+            ],
+            options={
+                'ordering': ('color',),
+            },
+        ),
+        migrations.CreateModel(
+            name='RecipesIngredient',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.PositiveSmallIntegerField(validators=[django.core.validators.MinValueValidator(1), django.core.validators.MaxValueValidator(1000)], verbose_name='Количество ингредиента')),
+                ('ingredient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='recipe_ingredients', to='food.ingredient', verbose_name='Ингредиент')),
+                ('recipe', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='recipe_ingredients', to='food.recipe', verbose_name='Рецепт')),
+            ],
+            options={
+                'ordering': ('recipe',),
+            },
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='ingredients',
+            field=models.ManyToManyField(through='food.RecipesIngredient', to='food.Ingredient', verbose_name='Ингредиенты'),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='tags',
+            field=models.ManyToManyField(related_name='tags', to='food.Tag', verbose_name='Тэг'),
+        ),
+        migrations.CreateModel(
+            name='ShoppingCart',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('in_shopping_card', models.BooleanField(default=False)),
+                ('recipe', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='food.recipe', verbose_name='Рецепт')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='user_recipes_cart', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+            options={
+                'ordering': ('user',),
+                'unique_together': {('user', 'recipe')},
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='recipe',
+            unique_together={('name',)},
+        ),
+        migrations.CreateModel(
+            name='Favorite',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('in_favorite', models.BooleanField(default=False)),
+                ('recipe', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='food.recipe', verbose_name='Рецепт')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='user_recipes_favor', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+            options={
+                'ordering': ('user',),
+                'unique_together': {('user', 'recipe')},
+            },
+        ),
+    ]
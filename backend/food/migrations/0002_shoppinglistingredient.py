@@ -0,0 +1,56 @@
+# Generated by Django 3.2.3 on 2026-10-18 17:36
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Sum
+import django.db.models.deletion
+
+
+def fill_shopping_lists(apps, schema_editor):
+    """Суммы для уже существующих списков покупок"""
+    RecipesIngredient = apps.get_model('food', 'RecipesIngredient')
+    ShoppingListIngredient = apps.get_model('food', 'ShoppingListIngredient')
+    totals = RecipesIngredient.objects.filter(
+        recipe__shoppingcart__isnull=False
+    ).values_list(
+        'recipe__shoppingcart__user_id',
+        'ingredient_id'
+    ).annotate(
+        total=Sum('amount')
+    ).order_by()
+    ShoppingListIngredient.objects.bulk_create(
+        (
+            ShoppingListIngredient(
+                user_id=user_id,
+                ingredient_id=ingredient_id,
+                amount=total
+            )
+            for user_id, ingredient_id, total in totals.iterator()
+        ),
+        batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('food', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShoppingListIngredient',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.IntegerField(verbose_name='Общее количество ингредиента')),
+                ('ingredient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='food.ingredient', verbose_name='Ингредиент')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='shopping_list_ingredients', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+            options={
+                'ordering': ('user',),
+                'unique_together': {('user', 'ingredient')},
+            },
+        ),
+        migrations.RunPython(fill_shopping_lists, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 3.2.3 on 2026-10-18 17:36
+
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_subquery(model):
+    """Подзапрос с количеством строк model для рецепта"""
+    return Coalesce(
+        Subquery(
+            model.objects.filter(
+                recipe=OuterRef('pk')
+            ).order_by().values('recipe').annotate(
+                total=Count('pk')
+            ).values('total'),
+            output_field=IntegerField()
+        ),
+        0
+    )
+
+
+def fill_counters(apps, schema_editor):
+    """Счетчики для уже существующих избранного и списков покупок"""
+    Recipe = apps.get_model('food', 'Recipe')
+    Recipe.objects.update(
+        favorite_count=count_subquery(apps.get_model('food', 'Favorite')),
+        cart_count=count_subquery(apps.get_model('food', 'ShoppingCart')),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('food', '0002_shoppinglistingredient'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='cart_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='В списках покупок'),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='favorite_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='В избранном'),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
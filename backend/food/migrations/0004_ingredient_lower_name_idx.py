@@ -0,0 +1,38 @@
+# Generated by Django 3.2.3 on 2026-10-18 17:36
+
+from django.db import migrations, models
+import django.db.models.functions.text
+
+
+class AddPatternIndex(migrations.AddIndex):
+    """На PostgreSQL индекс по lower(name) строится с text_pattern_ops:
+    обычный btree при локали не C не подходит для LIKE 'x%'"""
+
+    def database_forwards(self, app_label, schema_editor, from_state,
+                          to_state):
+        if schema_editor.connection.vendor != 'postgresql':
+            return super().database_forwards(
+                app_label, schema_editor, from_state, to_state
+            )
+        model = to_state.apps.get_model(app_label, self.model_name)
+        schema_editor.execute(
+            'CREATE INDEX %s ON %s (lower(%s) text_pattern_ops)' % (
+                schema_editor.quote_name(self.index.name),
+                schema_editor.quote_name(model._meta.db_table),
+                schema_editor.quote_name('name'),
+            )
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('food', '0003_recipe_counters'),
+    ]
+
+    operations = [
+        AddPatternIndex(
+            model_name='ingredient',
+            index=models.Index(django.db.models.functions.text.Lower('name'), name='ingredient_lower_name_idx'),
+        ),
+    ]
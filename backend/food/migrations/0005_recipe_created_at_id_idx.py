@@ -0,0 +1,17 @@
+# Generated by Django 3.2.3 on 2026-10-18 17:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('food', '0004_ingredient_lower_name_idx'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['-created_at', '-id'], name='recipe_created_at_id_idx'),
+        ),
+    ]
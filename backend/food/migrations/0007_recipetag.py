@@ -0,0 +1,51 @@
+# Generated by Django 3.2.3 on 2026-10-18 17:36
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    """RecipeTag описывает уже существующую таблицу food_recipe_tags,
+    которую Django создал для Recipe.tags: колонки и уникальность
+    (recipe_id, tag_id) те же. В базе меняются только тип id
+    на bigint, как у остальных моделей, и индекс (tag, recipe)"""
+
+    dependencies = [
+        ('food', '0006_image_variants'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.CreateModel(
+                    name='RecipeTag',
+                    fields=[
+                        ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                        ('recipe', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='food.recipe', verbose_name='Рецепт')),
+                        ('tag', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='food.tag', verbose_name='Тэг')),
+                    ],
+                    options={
+                        'db_table': 'food_recipe_tags',
+                    },
+                ),
+                migrations.AlterField(
+                    model_name='recipe',
+                    name='tags',
+                    field=models.ManyToManyField(related_name='tags', through='food.RecipeTag', to='food.Tag', verbose_name='Тэг'),
+                ),
+                migrations.AlterUniqueTogether(
+                    name='recipetag',
+                    unique_together={('recipe', 'tag')},
+                ),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='recipetag',
+            name='id',
+            field=models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID'),
+        ),
+        migrations.AddIndex(
+            model_name='recipetag',
+            index=models.Index(fields=['tag', 'recipe'], name='recipe_tags_tag_recipe_idx'),
+        ),
+    ]
@@ -0,0 +1,69 @@
+# Generated by Django 3.2.3 on 2026-10-18 17:36
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.contrib.postgres.aggregates import StringAgg
+from django.db import migrations
+from django.db.models import OuterRef, Subquery
+
+
+class AddPostgresIndex(migrations.AddIndex):
+    """GIN-индекс создается только на PostgreSQL,
+    на других базах меняется лишь состояние миграций"""
+
+    def database_forwards(self, app_label, schema_editor, from_state,
+                          to_state):
+        if schema_editor.connection.vendor == 'postgresql':
+            super().database_forwards(
+                app_label, schema_editor, from_state, to_state
+            )
+
+    def database_backwards(self, app_label, schema_editor, from_state,
+                           to_state):
+        if schema_editor.connection.vendor == 'postgresql':
+            super().database_backwards(
+                app_label, schema_editor, from_state, to_state
+            )
+
+
+def fill_search_vectors(apps, schema_editor):
+    """Векторы для уже существующих рецептов одним UPDATE"""
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    Recipe = apps.get_model('food', 'Recipe')
+    RecipesIngredient = apps.get_model('food', 'RecipesIngredient')
+    SearchVector = django.contrib.postgres.search.SearchVector
+    ingredient_names = RecipesIngredient.objects.filter(
+        recipe=OuterRef('pk')
+    ).order_by().values('recipe').annotate(
+        names=StringAgg('ingredient__name', ' ')
+    ).values('names')
+    Recipe.objects.update(search_vector=(
+        SearchVector('name', weight='A', config='russian')
+        + SearchVector('text', weight='B', config='russian')
+        + SearchVector(
+            Subquery(ingredient_names),
+            weight='C',
+            config='russian'
+        )
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('food', '0007_recipetag'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True, verbose_name='Поисковый вектор'),
+        ),
+        AddPostgresIndex(
+            model_name='recipe',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='recipe_search_vector_idx'),
+        ),
+        migrations.RunPython(fill_search_vectors, migrations.RunPython.noop),
+    ]
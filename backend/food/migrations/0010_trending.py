@@ -0,0 +1,61 @@
+# Generated by Django 3.2.3 on 2026-10-18 17:36
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+import django.utils.timezone
+
+
+def fill_created_at(apps, schema_editor):
+    """Старые избранное и списки покупок получили время миграции
+    и все разом попали бы в тренды. Точное время неизвестно, берем
+    нижнюю границу: время создания рецепта"""
+    Recipe = apps.get_model('food', 'Recipe')
+    recipe_created_at = Subquery(
+        Recipe.objects.filter(pk=OuterRef('recipe_id')).values('created_at')
+    )
+    for name in ('Favorite', 'ShoppingCart'):
+        apps.get_model('food', name).objects.update(
+            created_at=recipe_created_at
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('food', '0009_recipe_author_created_at_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='favorite',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False, verbose_name='Дата добавления'),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='trending_score',
+            field=models.FloatField(default=0, editable=False, verbose_name='Рейтинг в трендах'),
+        ),
+        migrations.AddField(
+            model_name='shoppingcart',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False, verbose_name='Дата добавления'),
+        ),
+        migrations.RunPython(fill_created_at, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='favorite',
+            index=models.Index(fields=['created_at'], name='favorite_created_at_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['-favorite_count', '-created_at', '-id'], name='recipe_popular_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['-trending_score', '-created_at', '-id'], name='recipe_trending_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='shoppingcart',
+            index=models.Index(fields=['created_at'], name='cart_created_at_idx'),
+        ),
+    ]
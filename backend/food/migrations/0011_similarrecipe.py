@@ -0,0 +1,39 @@
+# Generated by Django 3.2.3 on 2026-10-18 17:36
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('food', '0010_trending'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='similarity_outdated',
+            field=models.BooleanField(db_index=True, default=True, editable=False, verbose_name='Нужно пересчитать похожие рецепты'),
+        ),
+        migrations.CreateModel(
+            name='SimilarRecipe',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.FloatField(verbose_name='Сходство')),
+                ('recipe', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='similar_recipes', to='food.recipe', verbose_name='Рецепт')),
+                ('similar', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='food.recipe', verbose_name='Похожий рецепт')),
+            ],
+            options={
+                'ordering': ('recipe', '-score'),
+            },
+        ),
+        migrations.AddIndex(
+            model_name='similarrecipe',
+            index=models.Index(fields=['recipe', '-score'], name='similar_recipe_score_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='similarrecipe',
+            unique_together={('recipe', 'similar')},
+        ),
+    ]
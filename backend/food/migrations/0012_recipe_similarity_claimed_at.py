@@ -0,0 +1,18 @@
+# Generated by Django 3.2.3 on 2026-10-18 18:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('food', '0011_similarrecipe'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='similarity_claimed_at',
+            field=models.DateTimeField(editable=False, null=True, verbose_name='Начало пересчета похожих рецептов'),
+        ),
+    ]
@@ -1,12 +1,20 @@
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
+from django.db.models import Exists, F, OuterRef, Prefetch, Window
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Lower, RowNumber
+from django.utils import timezone
 
-from users.models import User
+from users.models import Subscribe, User
 
 MIN_COOKING_TIME = 1
 MAX_COOKING_TIME = 32000
 MIN_AMOUNT = 1
 MAX_AMOUNT = 1000
+SEARCH_CONFIG = 'russian'
+SIMILAR_COUNT = 20
 
 
 class Tag(models.Model):
@@ -47,11 +55,76 @@ class Ingredient(models.Model):
     class Meta:
         ordering = ('name', )
         unique_together = ('name', 'measurement_unit', )
+        # на PostgreSQL миграция строит его с text_pattern_ops
+        indexes = (
+            models.Index(Lower('name'), name='ingredient_lower_name_idx'),
+        )
 
     def __str__(self):
         return self.name
 
 
+def get_recipe_prefetches():
+    """Тэги и ингредиенты, нужные для полного представления рецепта"""
+    return (
+        'tags',
+        Prefetch(
+            'recipe_ingredients',
+            queryset=RecipesIngredient.objects.select_related('ingredient')
+        ),
+    )
+
+
+class RecipeQuerySet(models.QuerySet):
+    """Выборки рецептов для чтения"""
+
+    def with_related(self):
+        """Автор, тэги и ингредиенты одним набором запросов"""
+        return self.select_related('author').prefetch_related(
+            *get_recipe_prefetches()
+        )
+
+    def with_user_flags(self, user):
+        """Аннотирует флаги избранного и списка покупок для пользователя"""
+        if user.is_anonymous:
+            return self.annotate(
+                favorited=models.Value(False, models.BooleanField()),
+                in_shopping_cart=models.Value(False, models.BooleanField()),
+            )
+        return self.annotate(
+            favorited=Exists(Favorite.objects.filter(
+                user=user,
+                recipe=OuterRef('pk')
+            )),
+            in_shopping_cart=Exists(ShoppingCart.objects.filter(
+                user=user,
+                recipe=OuterRef('pk')
+            )),
+        )
+
+    def feed(self, user):
+        """Рецепты авторов, на которых подписан user"""
+        return self.filter(author__in=Subscribe.objects.filter(
+            follower=user
+        ).values('follow_id'))
+
+    def newest_per_author(self, limit):
+        """Не больше limit последних рецептов каждого автора из выборки,
+        ранжирование оконной функцией одним запросом"""
+        ranked = self.order_by().annotate(
+            recipe_rank=Window(
+                RowNumber(),
+                partition_by=[F('author_id')],
+                order_by=[F('created_at').desc(), F('id').desc()]
+            )
+        ).values('pk', 'recipe_rank')
+        sql, params = ranked.query.sql_with_params()
+        return self.model.objects.filter(pk__in=RawSQL(
+            f'SELECT id FROM ({sql}) AS ranked WHERE recipe_rank <= %s',
+            (*params, limit)
+        ))
+
+
 class Recipe(models.Model):
     """Модель рецептов"""
     author = models.ForeignKey(
@@ -70,6 +143,7 @@ class Recipe(models.Model):
     )
     tags = models.ManyToManyField(
         Tag,
+        through='RecipeTag',
         verbose_name='Тэг',
         related_name='tags',
     )
@@ -91,18 +165,77 @@ class Recipe(models.Model):
     )
     is_favorited = models.BooleanField(default=False)
     is_in_shopping_cart = models.BooleanField(default=False)
+    image_variants = models.JSONField(
+        default=dict,
+        blank=True,
+        editable=False,
+        verbose_name='Уменьшенные копии картинки'
+    )
+    favorite_count = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+        verbose_name='В избранном',
+    )
+    cart_count = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+        verbose_name='В списках покупок',
+    )
+    similarity_outdated = models.BooleanField(
+        default=True,
+        editable=False,
+        db_index=True,
+        verbose_name='Нужно пересчитать похожие рецепты',
+    )
+    similarity_claimed_at = models.DateTimeField(
+        null=True,
+        editable=False,
+        verbose_name='Начало пересчета похожих рецептов',
+    )
+    trending_score = models.FloatField(
+        default=0,
+        editable=False,
+        verbose_name='Рейтинг в трендах',
+    )
+    search_vector = SearchVectorField(
+        null=True,
+        editable=False,
+        verbose_name='Поисковый вектор'
+    )
     created_at = models.DateTimeField(auto_now_add=True, editable=False)
 
+    objects = RecipeQuerySet.as_manager()
+
     class Meta:
         ordering = ('-created_at', )
         unique_together = ('name', )
+        indexes = (
+            models.Index(
+                fields=('-created_at', '-id'),
+                name='recipe_created_at_id_idx'
+            ),
+            models.Index(
+                fields=('author', '-created_at', '-id'),
+                name='recipe_author_created_at_idx'
+            ),
+            models.Index(
+                fields=('-favorite_count', '-created_at', '-id'),
+                name='recipe_popular_idx'
+            ),
+            models.Index(
+                fields=('-trending_score', '-created_at', '-id'),
+                name='recipe_trending_idx'
+            ),
+            # на других базах миграция его пропускает
+            GinIndex(
+                fields=('search_vector', ),
+                name='recipe_search_vector_idx'
+            ),
+        )
 
     def __str__(self):
         return self.name
 
-    def favorite_count(self):
-        return Favorite.objects.filter(recipe=self).count()
-
 
 class RecipesIngredient(models.Model):
     """Связываящая модель Рецепт->Ингредиент"""
@@ -133,6 +266,33 @@ class RecipesIngredient(models.Model):
         return f'{self.recipe} с использованием {self.ingredient}'
 
 
+class RecipeTag(models.Model):
+    """Связывающая модель Рецепт->Тэг"""
+    recipe = models.ForeignKey(
+        Recipe,
+        on_delete=models.CASCADE,
+        verbose_name='Рецепт'
+    )
+    tag = models.ForeignKey(
+        Tag,
+        on_delete=models.CASCADE,
+        verbose_name='Тэг'
+    )
+
+    class Meta:
+        db_table = 'food_recipe_tags'
+        unique_together = ('recipe', 'tag', )
+        indexes = (
+            models.Index(
+                fields=('tag', 'recipe'),
+                name='recipe_tags_tag_recipe_idx'
+            ),
+        )
+
+    def __str__(self):
+        return f'{self.recipe} с тэгом {self.tag}'
+
+
 class ShoppingCart(models.Model):
     """Модель для списка покупок"""
     user = models.ForeignKey(
@@ -147,10 +307,21 @@ class ShoppingCart(models.Model):
         verbose_name='Рецепт'
     )
     in_shopping_card = models.BooleanField(default=False)
+    created_at = models.DateTimeField(
+        default=timezone.now,
+        editable=False,
+        verbose_name='Дата добавления'
+    )
 
     class Meta:
         ordering = ('user', )
         unique_together = ('user', 'recipe', )
+        indexes = (
+            models.Index(
+                fields=('created_at', ),
+                name='cart_created_at_idx'
+            ),
+        )
 
     def __str__(self):
         return f'{self.user} добавил {self.recipe} в список покупок'
@@ -170,10 +341,117 @@ class Favorite(models.Model):
         verbose_name='Рецепт'
     )
     in_favorite = models.BooleanField(default=False)
+    created_at = models.DateTimeField(
+        default=timezone.now,
+        editable=False,
+        verbose_name='Дата добавления'
+    )
 
     class Meta:
         ordering = ('user', )
         unique_together = ('user', 'recipe', )
+        indexes = (
+            models.Index(
+                fields=('created_at', ),
+                name='favorite_created_at_idx'
+            ),
+        )
 
     def __str__(self):
         return f'{self.recipe} в избранном у {self.user}'
+
+
+class ShoppingListIngredient(models.Model):
+    """Предрассчитанные суммы ингредиентов списка покупок пользователя"""
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        verbose_name='Пользователь',
+        related_name='shopping_list_ingredients'
+    )
+    ingredient = models.ForeignKey(
+        Ingredient,
+        on_delete=models.CASCADE,
+        verbose_name='Ингредиент'
+    )
+    amount = models.IntegerField(
+        verbose_name='Общее количество ингредиента'
+    )
+
+    class Meta:
+        ordering = ('user', )
+        unique_together = ('user', 'ingredient', )
+
+    def __str__(self):
+        return f'{self.ingredient} ({self.amount}) у {self.user}'
+
+
+class ImageJob(models.Model):
+    """Очередь обработки картинок рецептов"""
+    PENDING = 'pending'
+    PROCESSING = 'processing'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'В очереди'),
+        (PROCESSING, 'Обрабатывается'),
+        (DONE, 'Готово'),
+        (FAILED, 'Ошибка'),
+    )
+
+    recipe = models.OneToOneField(
+        Recipe,
+        on_delete=models.CASCADE,
+        verbose_name='Рецепт',
+        related_name='image_job'
+    )
+    image = models.CharField(
+        max_length=255,
+        verbose_name='Исходная картинка'
+    )
+    status = models.CharField(
+        max_length=16,
+        choices=STATUS_CHOICES,
+        default=PENDING,
+        db_index=True,
+        verbose_name='Статус'
+    )
+    attempts = models.PositiveSmallIntegerField(default=0)
+    error = models.TextField(blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ('updated_at', )
+
+    def __str__(self):
+        return f'{self.recipe}: {self.get_status_display()}'
+
+
+class SimilarRecipe(models.Model):
+    """Предрассчитанные похожие рецепты (TF-IDF по ингредиентам и тэгам)"""
+    recipe = models.ForeignKey(
+        Recipe,
+        on_delete=models.CASCADE,
+        verbose_name='Рецепт',
+        related_name='similar_recipes'
+    )
+    similar = models.ForeignKey(
+        Recipe,
+        on_delete=models.CASCADE,
+        verbose_name='Похожий рецепт',
+        related_name='+'
+    )
+    score = models.FloatField(verbose_name='Сходство')
+
+    class Meta:
+        ordering = ('recipe', '-score', )
+        unique_together = ('recipe', 'similar', )
+        indexes = (
+            models.Index(
+                fields=('recipe', '-score'),
+                name='similar_recipe_score_idx'
+            ),
+        )
+
+    def __str__(self):
+        return f'{self.similar} похож на {self.recipe} ({self.score:.2f})'
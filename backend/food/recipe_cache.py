@@ -0,0 +1,133 @@
+import hashlib
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import prefetch_related_objects
+from django.http import HttpResponse
+from rest_framework.renderers import JSONRenderer
+
+from . import api_cache
+from .models import get_recipe_prefetches
+from .viewer_state import get_viewer_state
+
+GLOBAL_SCOPES = ('tags', 'ingredients')
+VIEWER_FIELDS = ('is_favorited', 'is_in_shopping_cart')
+JSON_BOOL = {True: b'true', False: b'false'}
+
+
+def recipe_scope(recipe_id):
+    return f'recipe:{recipe_id}'
+
+
+def author_scope(author_id):
+    return f'author:{author_id}'
+
+
+def recipe_changed(recipe_id):
+    """Рецепт, его тэги или ингредиенты изменились"""
+    transaction.on_commit(
+        lambda: api_cache.bump_version(recipe_scope(recipe_id))
+    )
+
+
+def author_changed(author_id):
+    """Профиль автора изменился: устарели все его рецепты"""
+    transaction.on_commit(
+        lambda: api_cache.bump_version(author_scope(author_id))
+    )
+
+
+def get_payload_keys(recipes, base_url):
+    """Ключи кеша: id рецепта и версии всего, из чего он собран"""
+    scopes = set(GLOBAL_SCOPES)
+    for recipe in recipes:
+        scopes.add(recipe_scope(recipe.pk))
+        scopes.add(author_scope(recipe.author_id))
+    versions = api_cache.get_versions(scopes)
+    common = ':'.join(versions[scope] for scope in GLOBAL_SCOPES)
+    keys = {}
+    for recipe in recipes:
+        version = hashlib.md5(
+            f'{base_url}:{common}:{versions[recipe_scope(recipe.pk)]}:'
+            f'{versions[author_scope(recipe.author_id)]}'.encode()
+        ).hexdigest()
+        keys[recipe.pk] = f'recipe_payload:{recipe.pk}:{version}'
+    return keys
+
+
+def build_payloads(recipes, serialize):
+    """JSON рецептов без полей, зависящих от пользователя:
+    отдельно автор без is_subscribed и остальной рецепт"""
+    prefetch_related_objects(recipes, 'author', *get_recipe_prefetches())
+    renderer = JSONRenderer()
+    payloads = {}
+    for data in serialize(recipes):
+        author = data.pop('author')
+        author.pop('is_subscribed', None)
+        for field in VIEWER_FIELDS:
+            data.pop(field, None)
+        payloads[data['id']] = (
+            renderer.render(author),
+            renderer.render(data)
+        )
+    return payloads
+
+
+def render_recipes(recipes, request, serialize):
+    """JSON рецептов из кеша с флагами текущего пользователя.
+    serialize(recipes) нужен только для рецептов, которых нет в кеше"""
+    keys = get_payload_keys(recipes, request.build_absolute_uri('/'))
+    payloads = cache.get_many(keys.values())
+    missing = [recipe for recipe in recipes if keys[recipe.pk] not in payloads]
+    if missing:
+        built = {
+            keys[recipe_id]: payload
+            for recipe_id, payload in build_payloads(
+                missing,
+                serialize
+            ).items()
+        }
+        cache.set_many(built, api_cache.PAYLOAD_TIMEOUT)
+        payloads.update(built)
+    state = get_viewer_state({'request': request})
+    state.prime_authors({recipe.author_id for recipe in recipes})
+    return [
+        join_recipe(
+            payloads[keys[recipe.pk]],
+            state.is_subscribed(recipe.author_id),
+            recipe.favorited,
+            recipe.in_shopping_cart
+        )
+        for recipe in recipes
+    ]
+
+
+def join_recipe(payload, is_subscribed, is_favorited, is_in_shopping_cart):
+    author, body = payload
+    return b''.join((
+        b'{"author":{"is_subscribed":', JSON_BOOL[is_subscribed], b',',
+        author[1:],
+        b',"is_favorited":', JSON_BOOL[is_favorited],
+        b',"is_in_shopping_cart":', JSON_BOOL[is_in_shopping_cart], b',',
+        body[1:],
+    ))
+
+
+def join_list(items):
+    return b'[' + b','.join(items) + b']'
+
+
+def join_page(envelope, results):
+    """Вставляет готовый JSON results в ответ паджинатора"""
+    envelope = dict(envelope)
+    envelope.pop('results', None)
+    head = JSONRenderer().render(envelope)
+    if len(head) > 2:
+        head = head[:-1] + b','
+    else:
+        head = b'{'
+    return head + b'"results":' + results + b'}'
+
+
+def json_response(content):
+    return HttpResponse(content, content_type='application/json')
@@ -0,0 +1,69 @@
+from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.postgres.search import (SearchQuery, SearchRank,
+                                            SearchVector)
+from django.db import connection
+from django.db.models import Exists, F, OuterRef, Q, Subquery, Value
+
+from .models import SEARCH_CONFIG, Recipe, RecipesIngredient
+
+USE_POSTGRES_SEARCH = connection.vendor == 'postgresql'
+
+
+def update_search_vector(recipe):
+    """Пересчитывает поисковый вектор: название, описание, ингредиенты"""
+    if not USE_POSTGRES_SEARCH:
+        return
+    ingredient_names = ' '.join(
+        recipe.ingredients.values_list('name', flat=True)
+    )
+    Recipe.objects.filter(pk=recipe.pk).update(search_vector=(
+        SearchVector('name', weight='A', config=SEARCH_CONFIG)
+        + SearchVector('text', weight='B', config=SEARCH_CONFIG)
+        + SearchVector(
+            Value(ingredient_names),
+            weight='C',
+            config=SEARCH_CONFIG
+        )
+    ))
+
+
+def update_search_vectors(queryset):
+    """Пересчитывает векторы рецептов queryset одним UPDATE,
+    названия ингредиентов собираются подзапросом"""
+    if not USE_POSTGRES_SEARCH:
+        return
+    ingredient_names = RecipesIngredient.objects.filter(
+        recipe=OuterRef('pk')
+    ).order_by().values('recipe').annotate(
+        names=StringAgg('ingredient__name', ' ')
+    ).values('names')
+    queryset.update(search_vector=(
+        SearchVector('name', weight='A', config=SEARCH_CONFIG)
+        + SearchVector('text', weight='B', config=SEARCH_CONFIG)
+        + SearchVector(
+            Subquery(ingredient_names),
+            weight='C',
+            config=SEARCH_CONFIG
+        )
+    ))
+
+
+def search_recipes(queryset, text):
+    """Рецепты по релевантности; без PostgreSQL поиск по вхождению"""
+    if USE_POSTGRES_SEARCH:
+        query = SearchQuery(
+            text,
+            config=SEARCH_CONFIG,
+            search_type='websearch'
+        )
+        return queryset.filter(search_vector=query).annotate(
+            search_rank=SearchRank(F('search_vector'), query)
+        ).order_by('-search_rank', '-created_at', '-id')
+    return queryset.filter(
+        Q(name__icontains=text)
+        | Q(text__icontains=text)
+        | Exists(RecipesIngredient.objects.filter(
+            recipe=OuterRef('pk'),
+            ingredient__name__icontains=text
+        ))
+    )
@@ -1,17 +1,40 @@
 import base64
+import binascii
+import tempfile
+from collections import Counter
 
-from django.core.files.base import ContentFile
+from django.core.files import File
+from django.db import transaction
 from rest_framework import serializers
 from rest_framework.exceptions import PermissionDenied
 
+from core.instrumentation import TimedSerializerMixin
 from users.serializers import CustomMeSerializer
 
+from . import api_cache, cook_index, images, recipe_cache, shopping_list
+from .fields import ImageVariantsField
 from .models import (MAX_AMOUNT, MAX_COOKING_TIME, MIN_AMOUNT,
                      MIN_COOKING_TIME, Ingredient, Recipe, RecipesIngredient,
-                     Tag)
-
-
-class TagSerializer(serializers.ModelSerializer):
+                     RecipeTag, Tag)
+from .search import update_search_vector
+from .viewer_state import ViewerStateListSerializer, get_viewer_state
+
+IMAGE_TYPES = {
+    'png': 'png',
+    'jpeg': 'jpg',
+    'jpg': 'jpg',
+    'gif': 'gif',
+    'webp': 'webp',
+}
+MAX_IMAGE_SIZE = 10 * 1024 * 1024
+MAX_IMAGE_HEADER_LENGTH = 32
+IMAGE_SPOOL_SIZE = 1024 * 1024
+IMAGE_DECODE_CHUNK = 64 * 1024
+MAX_BULK_RECIPES = 100
+RECIPE_UPDATE_FIELDS = ('name', 'text', 'cooking_time', 'image')
+
+
+class TagSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     """Сериализатор для тэгов"""
     class Meta:
         model = Tag
@@ -23,7 +46,7 @@ class TagSerializer(serializers.ModelSerializer):
         )
 
 
-class IngredientSerializer(serializers.ModelSerializer):
+class IngredientSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     """Сериализатор для ингредиентов"""
     class Meta:
         model = Ingredient
@@ -61,24 +84,57 @@ class RecipeIngredientSerializer(serializers.ModelSerializer):
 
 
 class Base64ImageField(serializers.ImageField):
-    """Конвертация из base64"""
+    """Конвертация из base64.
+    Тип и размер проверяются до декодирования, декодирование идет
+    кусками во временный файл, а не одной копией в памяти"""
+    default_error_messages = {
+        'image_type': 'Unsupported image type, use one of: {types}.',
+        'image_size': 'Image is larger than {max_size} bytes.',
+        'image_data': 'Malformed base64 image data.',
+    }
+
     def to_internal_value(self, data):
         if isinstance(data, str) and data.startswith('data:image'):
-            format, imgstr = data.split(';base64,')
-            ext = format.split('/')[-1]
-            data = ContentFile(base64.b64decode(imgstr), name='temp.' + ext)
+            data = self.decode(data)
         return super().to_internal_value(data)
 
-
-class RecipeSerializer(serializers.ModelSerializer):
+    def decode(self, data):
+        header_end = data.find(';base64,', 0, MAX_IMAGE_HEADER_LENGTH)
+        if header_end == -1:
+            self.fail('image_data')
+        ext = data[len('data:image/'):header_end].lower()
+        if ext not in IMAGE_TYPES:
+            self.fail('image_type', types=', '.join(IMAGE_TYPES))
+        start = header_end + len(';base64,')
+        encoded_length = len(data) - start
+        if encoded_length % 4:
+            self.fail('image_data')
+        if encoded_length // 4 * 3 - data.count('=', -2) > MAX_IMAGE_SIZE:
+            self.fail('image_size', max_size=MAX_IMAGE_SIZE)
+        file = tempfile.SpooledTemporaryFile(max_size=IMAGE_SPOOL_SIZE)
+        try:
+            for offset in range(start, len(data), IMAGE_DECODE_CHUNK):
+                file.write(base64.b64decode(
+                    data[offset:offset + IMAGE_DECODE_CHUNK],
+                    validate=True
+                ))
+        except binascii.Error:
+            file.close()
+            self.fail('image_data')
+        file.seek(0)
+        return File(file, name=f'temp.{IMAGE_TYPES[ext]}')
+
+
+class RecipeSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     """Сериализатор для получения рецептов"""
     ingredients = RecipeIngredientSerializer(
         many=True,
         source='recipe_ingredients'
     )
     image = Base64ImageField(required=False, allow_null=True)
+    image_variants = ImageVariantsField()
     author = CustomMeSerializer()
-    tags = TagSerializer(many=True)
+    tags = serializers.SerializerMethodField()
     is_in_shopping_cart = serializers.SerializerMethodField()
     is_favorited = serializers.SerializerMethodField()
     cooking_time = serializers.IntegerField(
@@ -86,26 +142,47 @@ class RecipeSerializer(serializers.ModelSerializer):
         max_value=MAX_COOKING_TIME
     )
 
+    def get_tags(self, obj):
+        """Тэги берутся из общего кеша, а не сериализуются заново"""
+        if 'tags_by_id' not in self.context:
+            self.context['tags_by_id'] = api_cache.get_versioned(
+                'tags',
+                'by_id',
+                lambda: {
+                    tag['id']: tag for tag in TagSerializer(
+                        Tag.objects.all(), many=True
+                    ).data
+                }
+            )
+        tags_by_id = self.context['tags_by_id']
+        return [
+            tags_by_id.get(tag.id) or TagSerializer(tag).data
+            for tag in obj.tags.all()
+        ]
+
     def get_is_in_shopping_cart(self, obj):
         """Для отображения поля в списке покупок"""
-        user = self.context['request'].user
-        if user.is_anonymous:
-            return False
-        is_in_cart = user.user_recipes_cart.filter(recipe=obj).exists()
-
-        return is_in_cart
+        if hasattr(obj, 'in_shopping_cart'):
+            return obj.in_shopping_cart
+        return get_viewer_state(self.context).is_in_shopping_cart(obj.id)
 
     def get_is_favorited(self, obj):
         """Для отображения поля в избранном"""
-        user = self.context['request'].user
-        if user.is_anonymous:
-            return False
-        is_in_cart = user.user_recipes_favor.filter(recipe=obj).exists()
-
-        return is_in_cart
+        if hasattr(obj, 'favorited'):
+            return obj.favorited
+        return get_viewer_state(self.context).is_favorited(obj.id)
+
+    def prime_viewer_state(self, state, recipes):
+        """Флаги и подписки на авторов для всей страницы разом"""
+        state.prime_recipes(
+            [recipe.id for recipe in recipes
+             if not hasattr(recipe, 'favorited')]
+        )
+        state.prime_authors({recipe.author_id for recipe in recipes})
 
     class Meta:
         model = Recipe
+        list_serializer_class = ViewerStateListSerializer
         fields = (
             'id',
             'tags',
@@ -115,6 +192,7 @@ class RecipeSerializer(serializers.ModelSerializer):
             'is_in_shopping_cart',
             'name',
             'image',
+            'image_variants',
             'text',
             'cooking_time',
         )
@@ -122,7 +200,7 @@ class RecipeSerializer(serializers.ModelSerializer):
 
 class CrRecipeIngredientSerializer(serializers.ModelSerializer):
     """Сериализатор для ингредиентов->рецептов (создание)"""
-    id = serializers.PrimaryKeyRelatedField(queryset=Ingredient.objects.all())
+    id = serializers.IntegerField(min_value=1)
 
     class Meta:
         model = RecipesIngredient
@@ -135,63 +213,112 @@ class CrRecipeIngredientSerializer(serializers.ModelSerializer):
 class CrRecipeSerializer(serializers.ModelSerializer):
     """Сериализатор для создания рецептов"""
     ingredients = CrRecipeIngredientSerializer(many=True, required=True)
+    tags = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        allow_empty=False
+    )
     image = Base64ImageField(required=False, allow_null=True)
 
+    @transaction.atomic
     def create(self, validated_data):
         """POST для рецепта"""
-        print(validated_data)
-        author = self.context['request'].user
-        validated_data['author'] = author
+        validated_data['author'] = self.context['request'].user
         ingredient_data = validated_data.pop('ingredients')
         tags_data = validated_data.pop('tags')
         recipe = Recipe.objects.create(**validated_data)
-        if 'image' not in validated_data:
-            validated_data['image'] = ''
-        recipe_ingredients_objects = []
-        get_recipe_ingredient_objects(
-            ingredient_data,
+        RecipesIngredient.objects.bulk_create(
+            get_recipe_ingredient_objects(ingredient_data, recipe, [])
+        )
+        RecipeTag.objects.bulk_create([
+            RecipeTag(recipe=recipe, tag=tag) for tag in tags_data
+        ])
+        update_search_vector(recipe)
+        cook_index.recipe_changed(
             recipe,
-            recipe_ingredients_objects
+            [item['id'] for item in ingredient_data]
         )
-        RecipesIngredient.objects.bulk_create(recipe_ingredients_objects)
-        for tag in tags_data:
-            recipe.tags.add(tag)
+        if recipe.image:
+            images.enqueue(recipe)
         return recipe
 
+    @transaction.atomic
     def update(self, instance, validated_data):
-        """PATCH для рецепта"""
-        if instance.author != self.context['request'].user:
+        """PATCH для рецепта: записываются только изменения"""
+        if instance.author_id != self.context['request'].user.id:
             raise PermissionDenied
-        instance.name = validated_data.get('name')
-        instance.cooking_time = validated_data.get('cooking_time')
-        instance.text = validated_data.get('text')
-        instance.image = validated_data.get('image', instance.image)
-        instance.tags.set(validated_data.get('tags'))
-        instance.ingredients.clear()
-        recipe_ingredients_objects = []
-        get_recipe_ingredient_objects(
-            validated_data.get('ingredients'),
+        changed_fields = [
+            field for field in RECIPE_UPDATE_FIELDS
+            if field in validated_data
+            and getattr(instance, field) != validated_data[field]
+        ]
+        for field in changed_fields:
+            setattr(instance, field, validated_data[field])
+        tags_changed = update_recipe_tags(instance, validated_data['tags'])
+        old_amounts, new_amounts = update_recipe_ingredients(
             instance,
-            recipe_ingredients_objects
+            validated_data['ingredients']
         )
-        RecipesIngredient.objects.bulk_create(recipe_ingredients_objects)
-        instance.save()
+        if tags_changed or old_amounts.keys() != new_amounts.keys():
+            instance.similarity_outdated = True
+            instance.similarity_claimed_at = None
+            changed_fields += ['similarity_outdated', 'similarity_claimed_at']
+        if changed_fields:
+            instance.save(update_fields=changed_fields)
+        if old_amounts != new_amounts:
+            shopping_list.recipe_ingredients_changed(
+                instance,
+                old_amounts,
+                new_amounts
+            )
+            cook_index.recipe_changed(instance, list(new_amounts))
+        if old_amounts.keys() != new_amounts.keys() or (
+            {'name', 'text'} & set(changed_fields)
+        ):
+            update_search_vector(instance)
+        if 'image' in changed_fields:
+            images.enqueue(instance)
+        recipe_cache.recipe_changed(instance.pk)
         return instance
 
     def to_representation(self, instance):
-        """Переопределим отображение, вернется обычный рецептовый"""
-        return RecipeSerializer(
-            instance,
-            context={'request': self.context.get('request')}
-        ).data
+        """Переопределим отображение, вернется обычный рецептовый.
+        Рецепт перечитывается со связями и флагами: число запросов
+        не зависит от числа ингредиентов"""
+        request = self.context.get('request')
+        recipe = Recipe.objects.with_related().with_user_flags(
+            request.user
+        ).get(pk=instance.pk)
+        return RecipeSerializer(recipe, context={'request': request}).data
+
+    def validate_tags(self, data):
+        """Повторы тэгов отбрасываются, порядок сохраняется,
+        существование тэгов проверяется одним запросом"""
+        tag_ids = list(dict.fromkeys(data))
+        tags = Tag.objects.in_bulk(tag_ids)
+        missing_ids = [tag_id for tag_id in tag_ids if tag_id not in tags]
+        if missing_ids:
+            raise serializers.ValidationError(
+                f'Invalid tag id: {missing_ids}'
+            )
+        return [tags[tag_id] for tag_id in tag_ids]
 
     def validate_ingredients(self, data):
+        """Повторы и существование ингредиентов проверяются одним запросом"""
         seen_ids = set()
         for item in data:
             ingredient_id = item.get('id')
             if ingredient_id in seen_ids:
                 raise serializers.ValidationError('Duplicated ingredient id')
             seen_ids.add(ingredient_id)
+        missing_ids = seen_ids - set(
+            Ingredient.objects.filter(
+                pk__in=seen_ids
+            ).values_list('pk', flat=True)
+        )
+        if missing_ids:
+            raise serializers.ValidationError(
+                f'Invalid ingredient id: {sorted(missing_ids)}'
+            )
         return data
 
     class Meta:
@@ -206,17 +333,96 @@ class CrRecipeSerializer(serializers.ModelSerializer):
         )
 
 
+class BulkRecipesSerializer(serializers.Serializer):
+    """Сериализатор для пакетной работы с избранным и списком покупок"""
+    operation = serializers.ChoiceField(
+        choices=('add', 'remove', 'replace', 'clear')
+    )
+    recipes = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        max_length=MAX_BULK_RECIPES,
+        required=False,
+        default=list
+    )
+
+    def validate(self, data):
+        if data['operation'] in ('add', 'remove') and not data['recipes']:
+            raise serializers.ValidationError(
+                {'recipes': 'This list may not be empty.'}
+            )
+        return data
+
+
+def update_recipe_tags(recipe, tags):
+    """Удаляет снятые тэги и добавляет новые, не трогая остальные.
+    Вернет True, если набор тэгов изменился"""
+    old_ids = set(
+        RecipeTag.objects.filter(
+            recipe=recipe
+        ).values_list('tag_id', flat=True)
+    )
+    new_ids = {tag.id for tag in tags}
+    if old_ids - new_ids:
+        RecipeTag.objects.filter(
+            recipe=recipe,
+            tag_id__in=old_ids - new_ids
+        ).delete()
+    RecipeTag.objects.bulk_create([
+        RecipeTag(recipe=recipe, tag_id=tag_id)
+        for tag_id in new_ids - old_ids
+    ])
+    return old_ids != new_ids
+
+
+def update_recipe_ingredients(recipe, ingredient_data):
+    """Применяет разницу ингредиентов: вставка, новое количество, удаление.
+    Вернет количества ингредиентов до и после"""
+    old_objects = {
+        item.ingredient_id: item
+        for item in RecipesIngredient.objects.filter(recipe=recipe)
+    }
+    old_amounts = Counter({
+        ingredient_id: item.amount
+        for ingredient_id, item in old_objects.items()
+    })
+    new_amounts = Counter({
+        item['id']: item['amount'] for item in ingredient_data
+    })
+    removed = old_amounts.keys() - new_amounts.keys()
+    if removed:
+        RecipesIngredient.objects.filter(
+            recipe=recipe,
+            ingredient_id__in=removed
+        ).delete()
+    RecipesIngredient.objects.bulk_create([
+        RecipesIngredient(
+            recipe=recipe,
+            ingredient_id=ingredient_id,
+            amount=amount
+        )
+        for ingredient_id, amount in new_amounts.items()
+        if ingredient_id not in old_objects
+    ])
+    changed = []
+    for ingredient_id, item in old_objects.items():
+        if ingredient_id in new_amounts and (
+            item.amount != new_amounts[ingredient_id]
+        ):
+            item.amount = new_amounts[ingredient_id]
+            changed.append(item)
+    RecipesIngredient.objects.bulk_update(changed, ['amount'])
+    return old_amounts, new_amounts
+
+
 def get_recipe_ingredient_objects(ingredient_data,
                                   recipe,
                                   recipe_ingredients_objects):
 
     for item in ingredient_data:
-        ingredient = item['id']
-        amount = item['amount']
         recipe_ingredient = RecipesIngredient(
             recipe=recipe,
-            ingredient=ingredient,
-            amount=amount
+            ingredient_id=item['id'],
+            amount=item['amount']
         )
         recipe_ingredients_objects.append(recipe_ingredient)
 
@@ -0,0 +1,161 @@
+from collections import Counter
+
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Sum, Value, When
+
+from users.models import User
+
+from .models import RecipesIngredient, ShoppingCart, ShoppingListIngredient
+
+
+def get_recipe_amounts(recipe):
+    """Количество каждого ингредиента в рецепте"""
+    return Counter(dict(
+        RecipesIngredient.objects.filter(
+            recipe=recipe
+        ).values_list('ingredient_id', 'amount')
+    ))
+
+
+def get_recipes_amounts(recipe_ids):
+    """Суммарное количество каждого ингредиента в нескольких рецептах"""
+    return Counter(dict(
+        RecipesIngredient.objects.filter(
+            recipe_id__in=recipe_ids
+        ).values_list('ingredient_id').annotate(
+            total=Sum('amount')
+        ).order_by()
+    ))
+
+
+def get_cart_user_ids(recipe):
+    """Пользователи, у которых рецепт лежит в списке покупок"""
+    return list(
+        ShoppingCart.objects.filter(
+            recipe=recipe
+        ).values_list('user_id', flat=True)
+    )
+
+
+def calculate_totals():
+    """Живой пересчет сумм по всем спискам покупок"""
+    return RecipesIngredient.objects.filter(
+        recipe__shoppingcart__isnull=False
+    ).values_list(
+        'recipe__shoppingcart__user_id',
+        'ingredient_id'
+    ).annotate(
+        total=Sum('amount')
+    ).order_by()
+
+
+@transaction.atomic
+def apply_delta(user_ids, delta):
+    """Прибавляет delta {ingredient_id: количество} к спискам покупок.
+    Строки пользователей блокируются, как в пакетных операциях, чтобы
+    удаление обнулившейся суммы не потеряло параллельное добавление;
+    недостающие строки вставляются с нулем без ошибки на конфликте,
+    затем все суммы сдвигаются одним UPDATE"""
+    delta = {key: value for key, value in delta.items() if value}
+    if not user_ids or not delta:
+        return
+    list(
+        User.objects.select_for_update().filter(
+            pk__in=user_ids
+        ).order_by('pk').values_list('pk', flat=True)
+    )
+    ShoppingListIngredient.objects.bulk_create(
+        [
+            ShoppingListIngredient(
+                user_id=user_id,
+                ingredient_id=ingredient_id,
+                amount=0
+            )
+            for user_id in user_ids
+            for ingredient_id, amount in delta.items()
+            if amount > 0
+        ],
+        ignore_conflicts=True
+    )
+    ShoppingListIngredient.objects.filter(
+        user_id__in=user_ids,
+        ingredient_id__in=delta
+    ).update(amount=F('amount') + Case(
+        *(
+            When(ingredient_id=ingredient_id, then=Value(amount))
+            for ingredient_id, amount in delta.items()
+        ),
+        output_field=IntegerField()
+    ))
+    ShoppingListIngredient.objects.filter(
+        user_id__in=user_ids,
+        ingredient_id__in=delta,
+        amount__lte=0
+    ).delete()
+
+
+def add_recipe(user, recipe):
+    """Рецепт добавлен в список покупок"""
+    apply_delta([user.id], get_recipe_amounts(recipe))
+
+
+def remove_recipe(user, recipe):
+    """Рецепт убран из списка покупок"""
+    amounts = get_recipe_amounts(recipe)
+    apply_delta([user.id], {key: -value for key, value in amounts.items()})
+
+
+def add_recipes(user, recipe_ids):
+    """Несколько рецептов добавлены в список покупок"""
+    if recipe_ids:
+        apply_delta([user.id], get_recipes_amounts(recipe_ids))
+
+
+def remove_recipes(user, recipe_ids):
+    """Несколько рецептов убраны из списка покупок"""
+    if recipe_ids:
+        amounts = get_recipes_amounts(recipe_ids)
+        apply_delta(
+            [user.id],
+            {key: -value for key, value in amounts.items()}
+        )
+
+
+def clear(user):
+    """Список покупок очищен целиком"""
+    ShoppingListIngredient.objects.filter(user=user).delete()
+
+
+def recipe_ingredients_changed(recipe, old_amounts, new_amounts=None):
+    """Ингредиенты рецепта переписаны: переносим разницу во все списки"""
+    if new_amounts is None:
+        new_amounts = get_recipe_amounts(recipe)
+    delta = Counter(new_amounts)
+    delta.subtract(old_amounts)
+    apply_delta(get_cart_user_ids(recipe), delta)
+
+
+def recipe_deleted(recipe):
+    """Рецепт удаляется: вычитаем его из всех списков покупок"""
+    amounts = get_recipe_amounts(recipe)
+    apply_delta(
+        get_cart_user_ids(recipe),
+        {key: -value for key, value in amounts.items()}
+    )
+
+
+@transaction.atomic
+def rebuild():
+    """Полная пересборка таблицы из списков покупок"""
+    ShoppingListIngredient.objects.all().delete()
+    ShoppingListIngredient.objects.bulk_create(
+        (
+            ShoppingListIngredient(
+                user_id=user_id,
+                ingredient_id=ingredient_id,
+                amount=total
+            )
+            for user_id, ingredient_id, total in calculate_totals().iterator()
+        ),
+        batch_size=1000
+    )
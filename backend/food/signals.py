@@ -0,0 +1,48 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from users.models import Subscribe, User
+
+from . import api_cache, autocomplete, recipe_cache
+from .models import Ingredient, Recipe, RecipesIngredient, RecipeTag, Tag
+
+
+@receiver([post_save, post_delete], sender=Ingredient)
+def reset_ingredient_index(**kwargs):
+    """Изменился ингредиент: индекс и кеш ответов устарели"""
+    api_cache.bump_version('ingredients')
+    autocomplete.invalidate()
+
+
+@receiver([post_save, post_delete], sender=Tag)
+def reset_tags_cache(**kwargs):
+    """Изменился тэг: кеш ответов устарел"""
+    api_cache.bump_version('tags')
+
+
+@receiver([post_save, post_delete], sender=Recipe)
+def reset_recipe_payload(instance, **kwargs):
+    """Изменился рецепт: его готовый JSON устарел"""
+    recipe_cache.recipe_changed(instance.pk)
+
+
+@receiver([post_save, post_delete], sender=RecipesIngredient)
+@receiver([post_save, post_delete], sender=RecipeTag)
+def reset_recipe_relation_payload(instance, **kwargs):
+    """Изменились ингредиенты или тэги рецепта, например из админки"""
+    recipe_cache.recipe_changed(instance.recipe_id)
+
+
+@receiver(post_save, sender=User)
+def reset_author_payloads(instance, update_fields=None, **kwargs):
+    """Изменился профиль: устарели рецепты автора.
+    Обновление last_login при входе профиль не меняет"""
+    if update_fields and set(update_fields) <= {'last_login'}:
+        return
+    recipe_cache.author_changed(instance.pk)
+
+
+@receiver([post_save, post_delete], sender=Subscribe)
+def reset_feed_head(instance, **kwargs):
+    """Изменились подписки: кеш первой страницы ленты устарел"""
+    api_cache.bump_version(f'feed:{instance.follower_id}')
@@ -0,0 +1,208 @@
+import numpy as np
+from django.db import transaction
+from django.db.models import Count, Min
+from django.utils import timezone
+from scipy import sparse
+
+from .models import (SIMILAR_COUNT, Recipe, RecipesIngredient, RecipeTag,
+                     SimilarRecipe)
+
+TAG_WEIGHT = 0.5
+BLOCK_SIZE = 256
+
+
+def load_pairs(queryset, field):
+    """Пары (id рецепта, id признака) двумя массивами"""
+    pairs = np.fromiter(
+        (
+            value
+            for pair in queryset.values_list('recipe_id', field).iterator()
+            for value in pair
+        ),
+        dtype=np.int64
+    ).reshape(-1, 2)
+    return pairs[:, 0], pairs[:, 1]
+
+
+def build_matrix(recipe_ids, ingredient_pairs, tag_pairs):
+    """Строки рецептов, нормированные TF-IDF веса ингредиентов и тэгов.
+    recipe_ids отсортированы, признаки бинарные, тэги с весом TAG_WEIGHT"""
+    rows, columns, weights = [], [], []
+    offset = 0
+    for (pair_recipes, features), weight in (
+        (ingredient_pairs, 1.0),
+        (tag_pairs, TAG_WEIGHT),
+    ):
+        known = np.isin(pair_recipes, recipe_ids)
+        feature_ids, feature_columns = np.unique(
+            features[known],
+            return_inverse=True
+        )
+        rows.append(np.searchsorted(recipe_ids, pair_recipes[known]))
+        columns.append(feature_columns.reshape(-1) + offset)
+        weights.append(np.full(len(feature_columns), weight))
+        offset += len(feature_ids)
+    matrix = sparse.csr_matrix(
+        (np.concatenate(weights), (np.concatenate(rows),
+                                   np.concatenate(columns))),
+        shape=(len(recipe_ids), offset),
+        dtype=np.float32
+    )
+    matrix.sum_duplicates()
+    matrix.data = np.minimum(matrix.data, 1.0).astype(np.float32)
+    document_frequency = np.bincount(matrix.indices, minlength=offset)
+    idf = np.log((1 + len(recipe_ids)) / (1 + document_frequency)) + 1
+    matrix = matrix.multiply(idf.astype(np.float32)).tocsr()
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)))
+    norms[norms == 0] = 1
+    return sparse.csr_matrix(matrix.multiply(1 / norms), dtype=np.float32)
+
+
+def iter_similarity_blocks(matrix, rows):
+    """Косинусное сходство строк rows со всеми рецептами, блоками.
+    Частые ингредиенты и тэги делают результат почти плотным,
+    поэтому разреженная матрица умножается на плотный блок"""
+    for start in range(0, len(rows), BLOCK_SIZE):
+        block = rows[start:start + BLOCK_SIZE]
+        scores = np.ascontiguousarray(
+            (matrix @ matrix[block].T.toarray()).T
+        )
+        scores[np.arange(len(block)), block] = 0
+        yield block, scores
+
+
+def top_neighbours(scores, count=SIMILAR_COUNT):
+    """Индексы и сходство count лучших соседей для каждой строки"""
+    count = min(count, scores.shape[1] - 1)
+    if count <= 0:
+        return np.empty((len(scores), 0), dtype=np.int64), scores[:, :0]
+    best = np.argpartition(-scores, count - 1, axis=1)[:, :count]
+    best_scores = np.take_along_axis(scores, best, axis=1)
+    order = np.argsort(-best_scores, axis=1)
+    return (
+        np.take_along_axis(best, order, axis=1),
+        np.take_along_axis(best_scores, order, axis=1)
+    )
+
+
+def get_thresholds(recipe_ids):
+    """Худшее сходство в полном списке соседей каждого рецепта;
+    у неполного списка порог 0, в него попадет любой сосед"""
+    thresholds = np.zeros(len(recipe_ids), dtype=np.float32)
+    full_lists = SimilarRecipe.objects.values('recipe_id').annotate(
+        neighbours=Count('pk'),
+        worst=Min('score')
+    ).filter(
+        neighbours__gte=SIMILAR_COUNT
+    ).values_list('recipe_id', 'worst').order_by()
+    for recipe_id, worst in full_lists.iterator():
+        position = np.searchsorted(recipe_ids, recipe_id)
+        if position < len(recipe_ids) and recipe_ids[position] == recipe_id:
+            thresholds[position] = worst
+    return thresholds
+
+
+def claim_outdated():
+    """Помечает измененные рецепты временем начала пересчета.
+    Строки не блокируются: правка рецепта во время расчета снова
+    выставит флаг и сбросит метку, release_claimed его не тронет"""
+    claimed_at = timezone.now()
+    Recipe.objects.filter(similarity_outdated=True).update(
+        similarity_claimed_at=claimed_at
+    )
+    return claimed_at
+
+
+def claimed(claimed_at):
+    return Recipe.objects.filter(
+        similarity_outdated=True,
+        similarity_claimed_at=claimed_at
+    )
+
+
+def release_claimed(claimed_at):
+    """Сбрасывает флаг у рецептов, не измененных после claim_outdated.
+    При ошибке пересчета флаги остаются до следующего запуска"""
+    claimed(claimed_at).update(
+        similarity_outdated=False,
+        similarity_claimed_at=None
+    )
+
+
+def save_neighbours(recipe_ids, block, neighbours, scores, batch_size):
+    """Заменяет списки соседей рецептов block отдельной транзакцией.
+    Рецепты, удаленные во время расчета, пропускаются"""
+    block_ids = recipe_ids[block].tolist()
+    with transaction.atomic():
+        existing = set(Recipe.objects.filter(
+            pk__in=np.union1d(block_ids, recipe_ids[neighbours]).tolist()
+        ).values_list('pk', flat=True))
+        SimilarRecipe.objects.filter(recipe_id__in=block_ids).delete()
+        SimilarRecipe.objects.bulk_create(
+            (
+                SimilarRecipe(
+                    recipe_id=recipe_id,
+                    similar_id=int(recipe_ids[neighbour]),
+                    score=float(score)
+                )
+                for recipe_id, row_neighbours, row_scores in zip(
+                    block_ids,
+                    neighbours,
+                    scores
+                )
+                if recipe_id in existing
+                for neighbour, score in zip(row_neighbours, row_scores)
+                if score > 0 and recipe_ids[neighbour] in existing
+            ),
+            batch_size=batch_size
+        )
+
+
+def rebuild(full=False, batch_size=1000):
+    """Пересчитывает таблицу похожих рецептов.
+    Без full пересчитываются только измененные рецепты и те,
+    в чьи списки они теперь попадают или из которых выпадают.
+    Расчет идет вне транзакции, списки пишутся блоками по BLOCK_SIZE
+    рецептов. Вернет количество пересчитанных рецептов"""
+    claimed_at = claim_outdated()
+    outdated_ids = np.fromiter(
+        claimed(claimed_at).values_list('pk', flat=True),
+        dtype=np.int64
+    )
+    if not full and not len(outdated_ids):
+        return 0
+    recipe_ids = np.fromiter(
+        Recipe.objects.order_by('pk').values_list('pk', flat=True),
+        dtype=np.int64
+    )
+    matrix = build_matrix(
+        recipe_ids,
+        load_pairs(RecipesIngredient.objects.all(), 'ingredient_id'),
+        load_pairs(RecipeTag.objects.all(), 'tag_id')
+    )
+    if full:
+        rows = np.arange(len(recipe_ids))
+    else:
+        affected = np.isin(recipe_ids, outdated_ids)
+        thresholds = get_thresholds(recipe_ids)
+        for _, scores in iter_similarity_blocks(
+            matrix,
+            np.flatnonzero(affected)
+        ):
+            affected |= (scores > thresholds).any(axis=0)
+        affected |= np.isin(recipe_ids, np.fromiter(
+            SimilarRecipe.objects.filter(
+                similar__in=claimed(claimed_at)
+            ).values_list('recipe_id', flat=True).distinct(),
+            dtype=np.int64
+        ))
+        rows = np.flatnonzero(affected)
+    for block, scores in iter_similarity_blocks(matrix, rows):
+        save_neighbours(
+            recipe_ids,
+            block,
+            *top_neighbours(scores),
+            batch_size
+        )
+    release_claimed(claimed_at)
+    return len(rows)
@@ -0,0 +1,986 @@
+import base64
+import json
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import connection, connections
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from users.models import Subscribe, User
+
+from . import cook_index, shopping_list, similarity, trending
+from .filters import filter_by_user_relation
+from .models import (Favorite, Ingredient, Recipe, RecipesIngredient,
+                     RecipeTag, ShoppingCart, ShoppingListIngredient,
+                     SimilarRecipe, Tag)
+
+RECIPES_COUNT = 12
+
+
+def create_recipes(author, count, tags, ingredients):
+    """Рецепты с тэгами и ингредиентами для тестов"""
+    recipes = []
+    for number in range(count):
+        recipe = Recipe.objects.create(
+            author=author,
+            name=f'Рецепт {author.username} {number}',
+            text='Описание',
+            cooking_time=10
+        )
+        recipe.tags.set(tags)
+        RecipesIngredient.objects.bulk_create(
+            RecipesIngredient(recipe=recipe, ingredient=ingredient, amount=5)
+            for ingredient in ingredients
+        )
+        recipes.append(recipe)
+    return recipes
+
+
+class RecipeQueriesTest(TestCase):
+    """Количество запросов чтения рецептов не зависит от их числа"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(
+            username='author',
+            email='author@example.com',
+            password='password'
+        )
+        cls.user = User.objects.create_user(
+            username='user',
+            email='user@example.com',
+            password='password'
+        )
+        Subscribe.objects.create(follow=cls.author, follower=cls.user)
+        tags = [
+            Tag.objects.create(
+                name=f'Тэг {number}',
+                color=f'#00000{number}',
+                slug=f'tag{number}'
+            )
+            for number in range(3)
+        ]
+        ingredients = [
+            Ingredient.objects.create(
+                name=f'Ингредиент {number}',
+                measurement_unit='г'
+            )
+            for number in range(4)
+        ]
+        cls.recipes = create_recipes(
+            cls.author,
+            RECIPES_COUNT,
+            tags,
+            ingredients
+        )
+        for recipe in cls.recipes[::2]:
+            Favorite.objects.create(user=cls.user, recipe=recipe)
+            ShoppingCart.objects.create(user=cls.user, recipe=recipe)
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+
+    def assert_list_queries(self, queries, limit):
+        with self.assertNumQueries(queries):
+            response = self.client.get(f'/api/recipes/?limit={limit}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['results']), limit)
+
+    def test_list_anonymous(self):
+        """Аноним: COUNT, страница, автор, тэги, ингредиенты и словарь
+        тэгов; когда JSON рецептов в кеше, только COUNT и страница"""
+        for limit in (2, RECIPES_COUNT):
+            cache.clear()
+            self.assert_list_queries(6, limit)
+            self.assert_list_queries(2, limit)
+
+    def test_list_authenticated(self):
+        """Флаги пользователя приходят в запросе страницы,
+        подписки на авторов страницы одним запросом"""
+        self.client.force_authenticate(self.user)
+        for limit in (2, RECIPES_COUNT):
+            cache.clear()
+            self.assert_list_queries(7, limit)
+            self.assert_list_queries(3, limit)
+
+    def test_retrieve(self):
+        self.client.force_authenticate(self.user)
+        for recipe in self.recipes[:2]:
+            cache.clear()
+            with self.assertNumQueries(6):
+                response = self.client.get(f'/api/recipes/{recipe.pk}/')
+            self.assertEqual(response.status_code, 200)
+            with self.assertNumQueries(2):
+                response = self.client.get(f'/api/recipes/{recipe.pk}/')
+            data = response.json()
+            self.assertEqual(len(data['tags']), 3)
+            self.assertEqual(len(data['ingredients']), 4)
+            self.assertTrue(data['author']['is_subscribed'])
+            self.assertEqual(
+                data['is_favorited'],
+                recipe.pk in {item.pk for item in self.recipes[::2]}
+            )
+
+
+class UserRelationFilterTest(TestCase):
+    """is_favorited и is_in_shopping_cart: EXISTS по индексу (user, recipe)"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username='user',
+            email='user@example.com',
+            password='password'
+        )
+
+    def get_user_recipe_index(self, model):
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(
+                cursor,
+                model._meta.db_table
+            )
+        return next(
+            name for name, constraint in constraints.items()
+            if constraint['index']
+            and constraint['columns'] == ['user_id', 'recipe_id']
+        )
+
+    def test_explain_uses_user_recipe_index(self):
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+        for model in (Favorite, ShoppingCart):
+            index = self.get_user_recipe_index(model)
+            for value in (1, 0):
+                plan = filter_by_user_relation(
+                    Recipe.objects.all(),
+                    model,
+                    self.user,
+                    value
+                ).explain()
+                self.assertIn(index, plan)
+
+
+class RecipeKeysetTest(TestCase):
+    """Листание списка рецептов курсором"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(
+            username='author',
+            email='author@example.com',
+            password='password'
+        )
+        cls.recipes = create_recipes(cls.author, 6, [], [])
+        created_at = timezone.now().replace(microsecond=500)
+        for number, recipe in enumerate(cls.recipes):
+            Recipe.objects.filter(pk=recipe.pk).update(
+                created_at=created_at + timedelta(microseconds=100 * number)
+            )
+
+    def setUp(self):
+        self.client = APIClient()
+
+    def test_pages_within_one_millisecond(self):
+        """Рецепты в пределах одной миллисекунды не теряются"""
+        url = '/api/recipes/?cursor=&limit=2'
+        seen = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            seen.extend(recipe['id'] for recipe in response.json()['results'])
+            url = response.json()['next']
+        self.assertEqual(
+            seen,
+            [recipe.pk for recipe in reversed(self.recipes)]
+        )
+
+    def test_invalid_cursor(self):
+        for position in (['abc', 1], [None, 1], [1], 'abc'):
+            cursor = base64.urlsafe_b64encode(
+                json.dumps(position).encode()
+            ).decode()
+            response = self.client.get(f'/api/recipes/?cursor={cursor}')
+            self.assertEqual(response.status_code, 404, position)
+        response = self.client.get('/api/recipes/?cursor=%%%')
+        self.assertEqual(response.status_code, 404)
+
+    def test_search_with_cursor(self):
+        """Поиск листается страницами: курсор потерял бы релевантность"""
+        response = self.client.get('/api/recipes/?search=Рецепт&cursor=')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('cursor', response.json())
+        response = self.client.get('/api/recipes/?search=Рецепт&limit=2')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['count'], len(self.recipes))
+
+
+class RecipeWriteTest(TestCase):
+    """Создание рецепта через API"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username='author',
+            email='author@example.com',
+            password='password'
+        )
+        cls.tag = Tag.objects.create(name='Завтрак', color='#000000',
+                                     slug='breakfast')
+        cls.ingredient = Ingredient.objects.create(name='Соль',
+                                                   measurement_unit='г')
+        cls.ingredients = [
+            Ingredient.objects.create(
+                name=f'Ингредиент {number}',
+                measurement_unit='г'
+            )
+            for number in range(8)
+        ]
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def get_ingredients_data(self, count, amount=5):
+        return [
+            {'id': ingredient.pk, 'amount': amount}
+            for ingredient in self.ingredients[:count]
+        ]
+
+    def create_recipe(self, **data):
+        return self.client.post('/api/recipes/', {
+            'name': 'Омлет',
+            'text': 'Описание',
+            'cooking_time': 10,
+            'tags': [self.tag.pk],
+            'ingredients': [{'id': self.ingredient.pk, 'amount': 5}],
+            **data
+        }, format='json')
+
+    def test_tags_required(self):
+        response = self.create_recipe(tags=[])
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('tags', response.json())
+        self.assertFalse(Recipe.objects.exists())
+
+    def test_create_queries(self):
+        """Число запросов не зависит от числа ингредиентов"""
+        for count in (2, 8):
+            cache.clear()
+            with self.assertNumQueries(13):
+                response = self.create_recipe(
+                    name=f'Омлет {count}',
+                    ingredients=self.get_ingredients_data(count)
+                )
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(len(response.json()['ingredients']), count)
+
+    def test_update_queries(self):
+        """Рецепт лежит в списке покупок: суммы сдвигаются без запроса
+        на каждый ингредиент"""
+        buyer = User.objects.create_user(
+            username='buyer',
+            email='buyer@example.com',
+            password='password'
+        )
+        for count in (2, 8):
+            recipe_id = self.create_recipe(
+                name=f'Омлет {count}',
+                ingredients=self.get_ingredients_data(count)
+            ).json()['id']
+            ShoppingCart.objects.create(user=buyer, recipe_id=recipe_id)
+            shopping_list.add_recipes(buyer, [recipe_id])
+            cache.clear()
+            with self.assertNumQueries(21):
+                response = self.client.patch(f'/api/recipes/{recipe_id}/', {
+                    'name': f'Омлет {count}',
+                    'text': 'Описание',
+                    'cooking_time': 10,
+                    'tags': [self.tag.pk],
+                    'ingredients': self.get_ingredients_data(count, 7),
+                }, format='json')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(
+                [item['amount'] for item in response.json()['ingredients']],
+                [7] * count
+            )
+            self.assertEqual(
+                set(ShoppingListIngredient.objects.filter(
+                    user=buyer,
+                    ingredient__in=self.ingredients[:count]
+                ).values_list('amount', flat=True)),
+                {7}
+            )
+            ShoppingCart.objects.all().delete()
+            ShoppingListIngredient.objects.all().delete()
+
+    def test_unknown_tag(self):
+        response = self.create_recipe(tags=[self.tag.pk, self.tag.pk + 100])
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('tags', response.json())
+        self.assertFalse(Recipe.objects.exists())
+
+    def test_duplicated_tags(self):
+        response = self.create_recipe(tags=[self.tag.pk, self.tag.pk])
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(
+            RecipeTag.objects.filter(recipe_id=response.json()['id']).count(),
+            1
+        )
+
+
+class ShoppingListDownloadTest(TestCase):
+    """Выгрузка списка покупок в разных форматах"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username='user',
+            email='user@example.com',
+            password='password'
+        )
+        ingredients = [
+            Ingredient.objects.create(name=name, measurement_unit='г')
+            for name in ('Соль', 'Мука')
+        ]
+        for recipe in create_recipes(cls.user, 2, [], ingredients):
+            ShoppingCart.objects.create(user=cls.user, recipe=recipe)
+            shopping_list.add_recipe(cls.user, recipe)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def download(self, file_format):
+        response = self.client.get(
+            f'/api/recipes/download_shopping_cart/?file_format={file_format}'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(
+            f'filename="shopping_list.{file_format}"',
+            response['Content-Disposition']
+        )
+        return b''.join(response.streaming_content).decode()
+
+    def test_csv(self):
+        self.assertEqual(
+            self.download('csv'),
+            'Мука (г) - 10\r\nСоль (г) - 10\r\n'
+        )
+
+    def test_txt(self):
+        self.assertEqual(
+            self.download('txt'),
+            'Мука (г) - 10\nСоль (г) - 10\n'
+        )
+
+    def test_json(self):
+        self.assertEqual(json.loads(self.download('json')), [
+            {'name': 'Мука', 'measurement_unit': 'г', 'amount': 10},
+            {'name': 'Соль', 'measurement_unit': 'г', 'amount': 10},
+        ])
+
+    def test_unknown_format(self):
+        response = self.client.get(
+            '/api/recipes/download_shopping_cart/?file_format=xml'
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('errors', response.json())
+
+
+class ShoppingListTotalsTest(TestCase):
+    """Предрассчитанные суммы списка покупок следуют за изменениями"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username='user',
+            email='user@example.com',
+            password='password'
+        )
+        cls.tag = Tag.objects.create(name='Обед', color='#000000',
+                                     slug='lunch')
+        cls.salt, cls.flour, cls.sugar = [
+            Ingredient.objects.create(name=name, measurement_unit='г')
+            for name in ('Соль', 'Мука', 'Сахар')
+        ]
+        cls.recipes = create_recipes(
+            cls.user,
+            2,
+            [cls.tag],
+            [cls.salt, cls.flour]
+        )
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def get_totals(self):
+        return dict(ShoppingListIngredient.objects.filter(
+            user=self.user
+        ).values_list('ingredient_id', 'amount'))
+
+    def add(self, recipe):
+        response = self.client.post(
+            f'/api/recipes/{recipe.pk}/shopping_cart/'
+        )
+        self.assertEqual(response.status_code, 201)
+
+    def check_only(self):
+        call_command(
+            'rebuild_shopping_lists',
+            '--check-only',
+            stdout=StringIO()
+        )
+
+    def test_add_and_remove(self):
+        first, second = self.recipes
+        self.add(first)
+        self.assertEqual(
+            self.get_totals(),
+            {self.salt.pk: 5, self.flour.pk: 5}
+        )
+        self.add(second)
+        self.assertEqual(
+            self.get_totals(),
+            {self.salt.pk: 10, self.flour.pk: 10}
+        )
+        for recipe, expected in ((first, 5), (second, None)):
+            response = self.client.delete(
+                f'/api/recipes/{recipe.pk}/shopping_cart/'
+            )
+            self.assertEqual(response.status_code, 204)
+            self.assertEqual(
+                self.get_totals(),
+                {self.salt.pk: expected, self.flour.pk: expected}
+                if expected else {}
+            )
+        self.check_only()
+
+    def test_recipe_update(self):
+        """Новые количества и состав рецепта переносятся в список"""
+        self.add(self.recipes[0])
+        self.add(self.recipes[1])
+        response = self.client.patch(f'/api/recipes/{self.recipes[0].pk}/', {
+            'name': 'Новый рецепт',
+            'text': 'Описание',
+            'cooking_time': 10,
+            'tags': [self.tag.pk],
+            'ingredients': [
+                {'id': self.salt.pk, 'amount': 7},
+                {'id': self.sugar.pk, 'amount': 3},
+            ],
+        }, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            self.get_totals(),
+            {self.salt.pk: 12, self.flour.pk: 5, self.sugar.pk: 3}
+        )
+        self.check_only()
+
+    def test_check_only(self):
+        self.add(self.recipes[0])
+        self.check_only()
+        ShoppingListIngredient.objects.filter(
+            ingredient=self.salt
+        ).update(amount=1)
+        with self.assertRaises(CommandError):
+            self.check_only()
+        self.assertEqual(self.get_totals()[self.salt.pk], 1)
+        call_command('rebuild_shopping_lists', stdout=StringIO())
+        self.assertEqual(
+            self.get_totals(),
+            {self.salt.pk: 5, self.flour.pk: 5}
+        )
+
+    def test_admin(self):
+        """Связи в админке только на просмотр, удаление рецепта
+        вычитает его из списков покупок"""
+        self.add(self.recipes[0])
+        self.add(self.recipes[1])
+        admin = User.objects.create_superuser(
+            username='admin',
+            email='admin@example.com',
+            password='password'
+        )
+        self.client.force_login(admin)
+        for model in ('favorite', 'shoppingcart', 'recipesingredient',
+                      'shoppinglistingredient'):
+            response = self.client.get(f'/admin/food/{model}/add/')
+            self.assertEqual(response.status_code, 403, model)
+        response = self.client.post(
+            f'/admin/food/recipe/{self.recipes[0].pk}/delete/',
+            {'post': 'yes'}
+        )
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(
+            self.get_totals(),
+            {self.salt.pk: 5, self.flour.pk: 5}
+        )
+        self.check_only()
+
+
+class BulkUserRecipesTest(TestCase):
+    """Пакетные операции с избранным и списком покупок"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username='user',
+            email='user@example.com',
+            password='password'
+        )
+        cls.salt, cls.flour = [
+            Ingredient.objects.create(name=name, measurement_unit='г')
+            for name in ('Соль', 'Мука')
+        ]
+        cls.recipes = create_recipes(
+            cls.user,
+            3,
+            [],
+            [cls.salt, cls.flour]
+        )
+        cls.ids = [recipe.pk for recipe in cls.recipes]
+        cls.missing_id = max(cls.ids) + 1
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def bulk(self, url, operation, recipe_ids=()):
+        response = self.client.post(f'/api/recipes/{url}/bulk/', {
+            'operation': operation,
+            'recipes': list(recipe_ids),
+        }, format='json')
+        self.assertEqual(response.status_code, 200)
+        return [
+            (item['id'], item['status']) for item in response.json()['results']
+        ]
+
+    def get_counters(self, field):
+        return list(
+            Recipe.objects.order_by('pk').values_list(field, flat=True)
+        )
+
+    def get_totals(self):
+        return dict(ShoppingListIngredient.objects.filter(
+            user=self.user
+        ).values_list('ingredient_id', 'amount'))
+
+    def test_favorite(self):
+        first, second, third = self.ids
+        self.assertEqual(
+            self.bulk('favorite', 'add', [first, second, self.missing_id]),
+            [
+                (first, 'added'),
+                (second, 'added'),
+                (self.missing_id, 'not_found'),
+            ]
+        )
+        self.assertEqual(self.get_counters('favorite_count'), [1, 1, 0])
+        self.assertEqual(
+            self.bulk('favorite', 'add', [first]),
+            [(first, 'already_exists')]
+        )
+        self.assertEqual(
+            self.bulk('favorite', 'remove', [first, third]),
+            [(first, 'removed'), (third, 'not_in_list')]
+        )
+        self.assertEqual(self.get_counters('favorite_count'), [0, 1, 0])
+        self.assertEqual(
+            self.bulk('favorite', 'replace', [third]),
+            [(third, 'added'), (second, 'removed')]
+        )
+        self.assertEqual(self.get_counters('favorite_count'), [0, 0, 1])
+        self.assertEqual(
+            self.bulk('favorite', 'clear'),
+            [(third, 'removed')]
+        )
+        self.assertFalse(Favorite.objects.exists())
+        self.assertEqual(self.get_counters('favorite_count'), [0, 0, 0])
+
+    def test_shopping_cart(self):
+        """Суммы списка покупок и счетчики идут за пакетными операциями,
+        одиночное добавление видно пакетному"""
+        first, second, third = self.ids
+        response = self.client.post(f'/api/recipes/{first}/shopping_cart/')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(
+            self.bulk('shopping_cart', 'add', [first, second]),
+            [(first, 'already_exists'), (second, 'added')]
+        )
+        self.assertEqual(self.get_counters('cart_count'), [1, 1, 0])
+        self.assertEqual(
+            self.get_totals(),
+            {self.salt.pk: 10, self.flour.pk: 10}
+        )
+        self.assertEqual(
+            self.bulk('shopping_cart', 'remove', [first, self.missing_id]),
+            [(first, 'removed'), (self.missing_id, 'not_found')]
+        )
+        self.assertEqual(
+            self.get_totals(),
+            {self.salt.pk: 5, self.flour.pk: 5}
+        )
+        self.assertEqual(
+            self.bulk('shopping_cart', 'replace', [first, third]),
+            [(first, 'added'), (third, 'added'), (second, 'removed')]
+        )
+        self.assertEqual(self.get_counters('cart_count'), [1, 0, 1])
+        self.assertEqual(
+            self.get_totals(),
+            {self.salt.pk: 10, self.flour.pk: 10}
+        )
+        self.assertEqual(
+            self.bulk('shopping_cart', 'clear'),
+            [(first, 'removed'), (third, 'removed')]
+        )
+        self.assertFalse(ShoppingCart.objects.exists())
+        self.assertEqual(self.get_totals(), {})
+        self.assertEqual(self.get_counters('cart_count'), [0, 0, 0])
+
+    def test_validation(self):
+        for data in (
+            {'operation': 'add', 'recipes': []},
+            {'operation': 'merge', 'recipes': self.ids},
+            {'operation': 'remove'},
+        ):
+            response = self.client.post(
+                '/api/recipes/favorite/bulk/',
+                data,
+                format='json'
+            )
+            self.assertEqual(response.status_code, 400, data)
+
+
+class ProcessImageJobsTest(TransactionTestCase):
+    """Обработчик картинок с кешем в памяти процесса.
+    Команда закрывает устаревшие соединения, поэтому без транзакции
+    TestCase: внутри нее соединение закрылось бы посреди теста"""
+
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'
+    }})
+    def test_process_local_cache(self):
+        """Работает дальше, только предупреждает о кеше"""
+        stderr = StringIO()
+        call_command(
+            'process_image_jobs',
+            '--once',
+            '--workers=1',
+            stdout=StringIO(),
+            stderr=stderr
+        )
+        self.assertIn('Кеш в памяти процесса', stderr.getvalue())
+
+
+class TrendingScoresTest(TestCase):
+    """Пересчет рейтинга для ordering=trending"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username='user',
+            email='user@example.com',
+            password='password'
+        )
+        cls.recipes = create_recipes(cls.user, 4, [], [])
+
+    def test_update_scores(self):
+        """Активность в окне дает рейтинг, старая и отсутствующая - 0"""
+        fresh, cart, old, stale = self.recipes
+        Favorite.objects.create(user=self.user, recipe=fresh)
+        ShoppingCart.objects.create(user=self.user, recipe=cart)
+        ShoppingCart.objects.create(
+            user=self.user,
+            recipe=old,
+            created_at=timezone.now() - trending.WINDOW - timedelta(hours=1)
+        )
+        Recipe.objects.filter(pk__in=[old.pk, stale.pk]).update(
+            trending_score=5
+        )
+        self.assertEqual(trending.update_scores(batch_size=1), 4)
+        scores = dict(Recipe.objects.values_list('pk', 'trending_score'))
+        # активность считается по часам: за час вес падает до 0.5 ** (1/24)
+        self.assertTrue(0.97 < scores[fresh.pk] <= 1)
+        self.assertTrue(1.94 < scores[cart.pk] <= 2)
+        self.assertEqual(scores[old.pk], 0)
+        self.assertEqual(scores[stale.pk], 0)
+        response = APIClient().get('/api/recipes/?ordering=trending')
+        self.assertEqual(
+            [recipe['id'] for recipe in response.json()['results'][:2]],
+            [cart.pk, fresh.pk]
+        )
+
+
+class SimilarRecipesTest(TestCase):
+    """Пересчет похожих рецептов"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username='author',
+            email='author@example.com',
+            password='password'
+        )
+        cls.tag = Tag.objects.create(name='Завтрак', color='#000000',
+                                     slug='breakfast')
+        cls.ingredients = [
+            Ingredient.objects.create(
+                name=f'Ингредиент {number}',
+                measurement_unit='г'
+            )
+            for number in range(4)
+        ]
+        other_author = User.objects.create_user(
+            username='other',
+            email='other@example.com',
+            password='password'
+        )
+        cls.recipes = (
+            create_recipes(cls.user, 2, [cls.tag], cls.ingredients[:2])
+            + create_recipes(other_author, 1, [], cls.ingredients[2:])
+        )
+
+    def get_similar(self):
+        return set(SimilarRecipe.objects.values_list(
+            'recipe_id',
+            'similar_id'
+        ))
+
+    def test_rebuild(self):
+        first, second, other = self.recipes
+        self.assertEqual(similarity.rebuild(batch_size=1), 3)
+        self.assertEqual(
+            self.get_similar(),
+            {(first.pk, second.pk), (second.pk, first.pk)}
+        )
+        self.assertFalse(
+            Recipe.objects.filter(similarity_outdated=True).exists()
+        )
+        self.assertEqual(similarity.rebuild(), 0)
+        self.assertEqual(similarity.rebuild(full=True), 3)
+
+    def test_changed_during_rebuild(self):
+        """Рецепт, измененный во время расчета, остается устаревшим"""
+        other = self.recipes[2]
+        client = APIClient()
+        client.force_authenticate(other.author)
+        build_matrix = similarity.build_matrix
+
+        def edit_and_build(*args):
+            response = client.patch(f'/api/recipes/{other.pk}/', {
+                'name': other.name,
+                'text': other.text,
+                'cooking_time': other.cooking_time,
+                'tags': [self.tag.pk],
+                'ingredients': [
+                    {'id': ingredient.pk, 'amount': 5}
+                    for ingredient in self.ingredients[:2]
+                ],
+            }, format='json')
+            self.assertEqual(response.status_code, 200)
+            return build_matrix(*args)
+
+        with mock.patch.object(similarity, 'build_matrix', edit_and_build):
+            similarity.rebuild()
+        self.assertEqual(
+            list(Recipe.objects.filter(
+                similarity_outdated=True
+            ).values_list('pk', flat=True)),
+            [other.pk]
+        )
+        self.assertEqual(similarity.rebuild(), 3)
+        self.assertEqual(len(self.get_similar()), 6)
+        self.assertFalse(
+            Recipe.objects.filter(similarity_outdated=True).exists()
+        )
+
+
+class WhatCanICookTest(TestCase):
+    """Подбор рецептов по имеющимся ингредиентам"""
+
+    @classmethod
+    def setUpTestData(cls):
+        author = User.objects.create_user(
+            username='author',
+            email='author@example.com',
+            password='password'
+        )
+        cls.ingredients = [
+            Ingredient.objects.create(
+                name=f'Ингредиент {number}',
+                measurement_unit='г'
+            )
+            for number in range(3)
+        ]
+        cls.recipes = create_recipes(author, 2, [], cls.ingredients[:2])
+
+    def setUp(self):
+        cook_index._index = None
+
+    def test_limit(self):
+        ids = '&'.join(
+            f'ingredients={ingredient.pk}' for ingredient in self.ingredients
+        )
+        for limit, expected in (('0', 1), ('1', 1), ('', 2), ('-1', 2)):
+            response = APIClient().get(
+                f'/api/recipes/what_can_i_cook/?{ids}&limit={limit}'
+            )
+            self.assertEqual(response.status_code, 200, limit)
+            self.assertEqual(len(response.json()), expected, limit)
+            self.assertEqual(response.json()[0]['matched'], 2)
+            self.assertEqual(response.json()[0]['missing'], 0)
+
+
+@unittest.skipIf(
+    connection.vendor == 'sqlite'
+    and connection.settings_dict['TEST']['NAME'] in (None, ':memory:'),
+    'потокам нужна общая база, а не :memory:'
+)
+class ConcurrentTogglesTest(TransactionTestCase):
+    """Параллельные добавления и удаления не дают 500 и дублей"""
+    requests_count = 8
+
+    def setUp(self):
+        self.author = User.objects.create_user(
+            username='author',
+            email='author@example.com',
+            password='password'
+        )
+        self.user = User.objects.create_user(
+            username='user',
+            email='user@example.com',
+            password='password'
+        )
+        self.ingredients = [
+            Ingredient.objects.create(
+                name=f'Ингредиент {number}',
+                measurement_unit='г'
+            )
+            for number in range(3)
+        ]
+        self.recipes = create_recipes(self.author, 2, [], self.ingredients)
+
+    def send(self, method, url, data=None):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        try:
+            return getattr(client, method)(
+                url,
+                data,
+                format='json'
+            ).status_code
+        finally:
+            connections.close_all()
+
+    def send_parallel(self, method, urls):
+        with ThreadPoolExecutor(max_workers=self.requests_count) as pool:
+            return sorted(pool.map(
+                lambda url: self.send(method, url),
+                urls * self.requests_count
+            ))
+
+    def test_favorite(self):
+        recipe = self.recipes[0]
+        url = f'/api/recipes/{recipe.pk}/favorite/'
+        self.assertEqual(
+            self.send_parallel('post', [url]),
+            [201] + [400] * (self.requests_count - 1)
+        )
+        recipe.refresh_from_db()
+        self.assertEqual(Favorite.objects.count(), 1)
+        self.assertEqual(recipe.favorite_count, 1)
+        self.assertEqual(
+            self.send_parallel('delete', [url]),
+            [204] + [400] * (self.requests_count - 1)
+        )
+        recipe.refresh_from_db()
+        self.assertFalse(Favorite.objects.exists())
+        self.assertEqual(recipe.favorite_count, 0)
+
+    def test_shopping_cart(self):
+        """Оба рецепта с общими ингредиентами: суммы складываются"""
+        urls = [
+            f'/api/recipes/{recipe.pk}/shopping_cart/'
+            for recipe in self.recipes
+        ]
+        self.assertEqual(
+            self.send_parallel('post', urls),
+            [201] * 2 + [400] * (2 * self.requests_count - 2)
+        )
+        self.assertEqual(ShoppingCart.objects.count(), 2)
+        self.assertEqual(
+            sorted(ShoppingListIngredient.objects.values_list(
+                'ingredient_id',
+                'amount'
+            )),
+            [(ingredient.pk, 10) for ingredient in self.ingredients]
+        )
+        self.assertEqual(
+            list(Recipe.objects.values_list('cart_count', flat=True)),
+            [1, 1]
+        )
+        self.assertEqual(
+            self.send_parallel('delete', urls),
+            [204] * 2 + [400] * (2 * self.requests_count - 2)
+        )
+        self.assertFalse(ShoppingCart.objects.exists())
+        self.assertFalse(ShoppingListIngredient.objects.exists())
+        self.assertEqual(
+            list(Recipe.objects.values_list('cart_count', flat=True)),
+            [0, 0]
+        )
+
+    def test_bulk_and_single(self):
+        """Пакетное и одиночное добавление одних рецептов в список
+        покупок идут по очереди: без 500 и без дублей"""
+        first, second = self.recipes
+        single_url = f'/api/recipes/{first.pk}/shopping_cart/'
+        bulk_data = {'operation': 'add', 'recipes': [first.pk, second.pk]}
+
+        def send(number):
+            if number % 2:
+                return self.send('post', single_url)
+            return self.send(
+                'post',
+                '/api/recipes/shopping_cart/bulk/',
+                bulk_data
+            )
+
+        with ThreadPoolExecutor(max_workers=self.requests_count) as pool:
+            statuses = set(pool.map(send, range(self.requests_count)))
+        self.assertLessEqual(statuses, {200, 201, 400})
+        self.assertEqual(ShoppingCart.objects.count(), 2)
+        self.assertEqual(
+            sorted(ShoppingListIngredient.objects.values_list(
+                'ingredient_id',
+                'amount'
+            )),
+            [(ingredient.pk, 10) for ingredient in self.ingredients]
+        )
+        self.assertEqual(
+            list(Recipe.objects.values_list('cart_count', flat=True)),
+            [1, 1]
+        )
+
+    def test_subscribe(self):
+        url = f'/api/users/{self.author.pk}/subscribe/'
+        self.assertEqual(
+            self.send_parallel('post', [url]),
+            [200] + [400] * (self.requests_count - 1)
+        )
+        self.assertEqual(Subscribe.objects.count(), 1)
+        self.assertEqual(
+            self.send_parallel('delete', [url]),
+            [204] + [400] * (self.requests_count - 1)
+        )
+        self.assertFalse(Subscribe.objects.exists())
@@ -0,0 +1,67 @@
+from collections import defaultdict
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Count, Exists, OuterRef, Q
+from django.db.models.functions import TruncHour
+from django.utils import timezone
+
+from .models import Favorite, Recipe, ShoppingCart
+
+HALF_LIFE = timedelta(hours=24)
+WINDOW = timedelta(days=7)
+ACTIVITY_WEIGHTS = (
+    (Favorite, 1.0),
+    (ShoppingCart, 2.0),
+)
+
+
+def calculate_scores(now, half_life=HALF_LIFE, window=WINDOW):
+    """Рейтинг рецептов: добавления в избранное и списки покупок
+    за window, вес каждого падает вдвое за half_life"""
+    scores = defaultdict(float)
+    for model, weight in ACTIVITY_WEIGHTS:
+        activity = model.objects.filter(
+            created_at__gte=now - window
+        ).annotate(
+            hour=TruncHour('created_at')
+        ).values_list('recipe_id', 'hour').annotate(
+            total=Count('pk')
+        ).order_by()
+        for recipe_id, hour, total in activity.iterator():
+            age = max(now - hour, timedelta(0))
+            scores[recipe_id] += weight * total * 0.5 ** (age / half_life)
+    return scores
+
+
+def has_activity(since):
+    """Условие: рецепт добавляли в избранное или список покупок
+    начиная с since"""
+    condition = Q()
+    for model, _ in ACTIVITY_WEIGHTS:
+        condition |= Q(Exists(model.objects.filter(
+            recipe=OuterRef('pk'),
+            created_at__gte=since
+        )))
+    return condition
+
+
+@transaction.atomic
+def update_scores(batch_size=1000, half_life=HALF_LIFE, window=WINDOW):
+    """Записывает новые рейтинги, рецептам без активности ставит 0.
+    Списки id в запрос не передаются: сброс идет по EXISTS,
+    запись - пачками по batch_size. Вернет количество обновленных"""
+    now = timezone.now()
+    scores = calculate_scores(now, half_life, window)
+    stale = Recipe.objects.filter(
+        trending_score__gt=0
+    ).exclude(has_activity(now - window)).update(trending_score=0)
+    Recipe.objects.bulk_update(
+        [
+            Recipe(pk=recipe_id, trending_score=round(score, 6))
+            for recipe_id, score in scores.items()
+        ],
+        ['trending_score'],
+        batch_size=batch_size
+    )
+    return stale + len(scores)
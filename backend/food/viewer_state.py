@@ -0,0 +1,93 @@
+from django.contrib.auth.models import AnonymousUser
+from rest_framework import serializers
+
+from users.models import Subscribe
+
+from .models import Favorite, ShoppingCart
+
+
+class ViewerState:
+    """Подписки, избранное и список покупок текущего пользователя.
+    Грузится пачками только для id, которые есть на странице,
+    и живет в рамках одного запроса"""
+    def __init__(self, user):
+        self.user = user
+        self.subscribed = {}
+        self.favorited = {}
+        self.in_cart = {}
+
+    def load(self, known, model, user_field, field, ids):
+        missing = set(ids) - known.keys()
+        if self.user.is_anonymous or not missing:
+            return
+        found = set(model.objects.filter(
+            **{user_field: self.user, f'{field}__in': missing}
+        ).values_list(field, flat=True))
+        for pk in missing:
+            known[pk] = pk in found
+
+    def prime_authors(self, ids):
+        self.load(
+            self.subscribed,
+            Subscribe,
+            'follower',
+            'follow_id',
+            ids
+        )
+
+    def prime_recipes(self, ids):
+        self.load(
+            self.favorited,
+            Favorite,
+            'user',
+            'recipe_id',
+            ids
+        )
+        self.load(
+            self.in_cart,
+            ShoppingCart,
+            'user',
+            'recipe_id',
+            ids
+        )
+
+    def is_subscribed(self, author_id):
+        if self.user.is_anonymous:
+            return False
+        self.prime_authors([author_id])
+        return self.subscribed[author_id]
+
+    def is_favorited(self, recipe_id):
+        if self.user.is_anonymous:
+            return False
+        self.prime_recipes([recipe_id])
+        return self.favorited[recipe_id]
+
+    def is_in_shopping_cart(self, recipe_id):
+        if self.user.is_anonymous:
+            return False
+        self.prime_recipes([recipe_id])
+        return self.in_cart[recipe_id]
+
+
+def get_viewer_state(context):
+    """Состояние пользователя запроса из контекста сериализатора"""
+    request = context.get('request')
+    if request is None:
+        return ViewerState(AnonymousUser())
+    state = getattr(request, 'viewer_state', None)
+    if state is None:
+        state = ViewerState(request.user)
+        request.viewer_state = state
+    return state
+
+
+class ViewerStateListSerializer(serializers.ListSerializer):
+    """Перед отрисовкой списка грузит состояние для всех его объектов"""
+    def to_representation(self, data):
+        items = list(data.all() if hasattr(data, 'all') else data)
+        state = get_viewer_state(self.context)
+        prime = getattr(self.child, 'prime_viewer_state', None)
+        if prime is not None:
+            prime(state, items)
+        return super().to_representation(items)
@@ -1,38 +1,186 @@
 import csv
+import json
 
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponse
+from django.core.cache import cache
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F
+from django.http import StreamingHttpResponse
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import status
 from rest_framework.decorators import action, api_view
-from rest_framework.permissions import AllowAny, IsAuthenticatedOrReadOnly
+from rest_framework.exceptions import ValidationError
+from rest_framework.permissions import (AllowAny, IsAuthenticated,
+                                        IsAuthenticatedOrReadOnly)
 from rest_framework.response import Response
 from rest_framework.viewsets import ModelViewSet, ReadOnlyModelViewSet
 
+from users.models import User
 from users.serializers import DetailRecipeSerializer
 from users.views import ListPagination
 
-from .filters import IngredientFilter, RecipeFilter
-from .models import Favorite, Ingredient, Recipe, ShoppingCart, Tag
-from .serializers import (CrRecipeSerializer, IngredientSerializer,
-                          RecipeSerializer, TagSerializer)
+from . import api_cache, autocomplete, cook_index, recipe_cache, shopping_list
+from .api_cache import VersionedCacheMixin
+from .filters import IngredientFilter, RecipeFilter, get_recipe_ordering
+from .models import (SIMILAR_COUNT, Favorite, Ingredient, Recipe, ShoppingCart,
+                     ShoppingListIngredient, SimilarRecipe, Tag)
+from .serializers import (BulkRecipesSerializer, CrRecipeSerializer,
+                          IngredientSerializer, RecipeSerializer,
+                          TagSerializer)
 
 
-class TagViewSet(ReadOnlyModelViewSet):
+class TagViewSet(VersionedCacheMixin, ReadOnlyModelViewSet):
     """Представление вернет список тэгов или тэг"""
+    cache_scope = 'tags'
     queryset = Tag.objects.all()
     serializer_class = TagSerializer
     permission_classes = [AllowAny, ]
 
 
-class IngredientViewSet(ReadOnlyModelViewSet):
+class IngredientViewSet(VersionedCacheMixin, ReadOnlyModelViewSet):
     """Представление вернет список ингредиентов или ингредиент"""
+    cache_scope = 'ingredients'
     queryset = Ingredient.objects.all()
     serializer_class = IngredientSerializer
     permission_classes = [AllowAny, ]
     filter_backends = [DjangoFilterBackend, ]
     filterset_class = IngredientFilter
 
+    @action(detail=False, methods=['GET'], url_path='autocomplete')
+    def autocomplete(self, request):
+        """Быстрый поиск из индекса в памяти для подсказок при вводе"""
+        name = request.query_params.get('name', '')
+        try:
+            limit = int(request.query_params.get(
+                'limit',
+                autocomplete.AUTOCOMPLETE_LIMIT
+            ))
+        except ValueError:
+            limit = autocomplete.AUTOCOMPLETE_LIMIT
+        limit = max(1, min(limit, autocomplete.MAX_AUTOCOMPLETE_LIMIT))
+        if not name:
+            return Response([])
+        return Response(autocomplete.get_index().search(name, limit))
+
+
+SIMILAR_LIMIT = 10
+
+
+def change_counter(recipe, field, value):
+    """Атомарно сдвигает счетчик рецепта на value"""
+    change_counters([recipe.pk], field, value)
+
+
+def change_counters(recipe_ids, field, value):
+    """Атомарно сдвигает счетчик нескольких рецептов на value"""
+    if recipe_ids and value:
+        Recipe.objects.filter(
+            pk__in=recipe_ids
+        ).update(**{field: F(field) + value})
+
+
+def create_once(model, **fields):
+    """INSERT в точке сохранения: False, если такая строка уже есть"""
+    try:
+        with transaction.atomic():
+            model.objects.create(**fields)
+    except IntegrityError:
+        return False
+    return True
+
+
+def lock_user(user):
+    """Блокирует строку пользователя до конца транзакции. Одиночные
+    и пакетные операции с избранным и списком покупок берут ее первой,
+    поэтому идут по очереди и не встают во взаимную блокировку.
+    Где нет SELECT FOR UPDATE (SQLite), блокировку на запись берет
+    пустой UPDATE: иначе чтение первым не дождалось бы чужой записи"""
+    users = User.objects.filter(pk=user.pk)
+    if connection.features.has_select_for_update:
+        list(users.select_for_update().values('pk'))
+    else:
+        users.update(id=F('id'))
+
+
+def bulk_user_recipes(user, model, operation, recipe_ids, **defaults):
+    """Пакетно добавляет и удаляет рецепты пользователя в model.
+    Вернет результат по каждому id и множества добавленных и удаленных"""
+    lock_user(user)
+    found = set(
+        Recipe.objects.filter(pk__in=recipe_ids).values_list('pk', flat=True)
+    )
+    current = model.objects.filter(user=user)
+    if operation in ('add', 'remove'):
+        current = current.filter(recipe_id__in=found)
+    current = set(current.values_list('recipe_id', flat=True))
+    to_add, to_remove = set(), set()
+    if operation in ('add', 'replace'):
+        to_add = found - current
+    if operation == 'remove':
+        to_remove = found & current
+    elif operation == 'replace':
+        to_remove = current - found
+    elif operation == 'clear':
+        to_remove = current
+    model.objects.bulk_create([
+        model(user=user, recipe_id=recipe_id, **defaults)
+        for recipe_id in to_add
+    ])
+    if to_remove:
+        model.objects.filter(user=user, recipe_id__in=to_remove).delete()
+    results = []
+    for recipe_id in dict.fromkeys(recipe_ids):
+        if recipe_id not in found:
+            result = 'not_found'
+        elif recipe_id in to_add:
+            result = 'added'
+        elif recipe_id in to_remove:
+            result = 'removed'
+        elif recipe_id in current:
+            result = 'already_exists'
+        else:
+            result = 'not_in_list'
+        results.append({'id': recipe_id, 'status': result})
+    results.extend(
+        {'id': recipe_id, 'status': 'removed'}
+        for recipe_id in sorted(to_remove.difference(recipe_ids))
+    )
+    return results, to_add, to_remove
+
+
+class FeedPagination(ListPagination):
+    """Лента листается только курсором.
+    Первая страница без фильтров кешируется на head_timeout секунд
+    и сбрасывается при изменении подписок"""
+    keyset_only = True
+    head_timeout = 30
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if request.query_params.get(self.cursor_query_param) or (
+            set(request.query_params) - {
+                self.cursor_query_param,
+                self.page_size_query_param
+            }
+        ):
+            return super().paginate_queryset(queryset, request, view)
+        user_id = request.user.id
+        version, _ = api_cache.get_version(f'feed:{user_id}')
+        key = f'feed_head:{user_id}:{version}:{self.get_page_size(request)}'
+        head = cache.get(key)
+        if head is None:
+            recipes = super().paginate_queryset(queryset, request, view)
+            cache.set(
+                key,
+                ([recipe.pk for recipe in recipes], self.next_position),
+                self.head_timeout
+            )
+            return recipes
+        recipe_ids, self.next_position = head
+        self.request = request
+        self.keyset_ordering = view.keyset_ordering
+        recipes = queryset.in_bulk(recipe_ids)
+        return [recipes[pk] for pk in recipe_ids if pk in recipes]
+
 
 class RecipeViewSet(ModelViewSet):
     """Представление вернет список рецептов или рецепт"""
@@ -43,12 +191,69 @@ class RecipeViewSet(ModelViewSet):
     filterset_class = RecipeFilter
     http_method_names = ['get', 'post', 'delete', 'patch']
 
+    @property
+    def keyset_ordering(self):
+        """Курсор идет по тем же полям, что и сортировка списка.
+        Поиск сортирует по релевантности, курсор по ней не листает;
+        лента с поиском остается хронологической"""
+        if self.action == 'list' and self.request.query_params.get('search'):
+            raise ValidationError(
+                {'cursor': 'Cursor pagination is not available with search'}
+            )
+        return get_recipe_ordering(self.request)
+
     def get_serializer_class(self):
         """Задаем различные сериализаторы в зависимости от метода"""
-        if self.action in ('list', 'retrieve'):
+        if self.action in ('list', 'retrieve', 'feed'):
             return RecipeSerializer
         return CrRecipeSerializer
 
+    def get_queryset(self):
+        """Для чтения флаги пользователя берем сразу в запросе,
+        связи подгружаются только для рецептов, которых нет в кеше"""
+        queryset = super().get_queryset()
+        if self.action == 'feed':
+            queryset = queryset.feed(self.request.user)
+        if self.action in ('list', 'retrieve', 'feed'):
+            return queryset.with_user_flags(self.request.user)
+        return queryset
+
+    def serialize_recipes(self, recipes):
+        return self.get_serializer(recipes, many=True).data
+
+    def list(self, request, *args, **kwargs):
+        """Список рецептов собирается из кеша готового JSON"""
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        recipes = list(queryset if page is None else page)
+        results = recipe_cache.join_list(recipe_cache.render_recipes(
+            recipes,
+            request,
+            self.serialize_recipes
+        ))
+        if page is not None:
+            results = recipe_cache.join_page(
+                self.get_paginated_response(None).data,
+                results
+            )
+        return recipe_cache.json_response(results)
+
+    @action(detail=False, methods=['GET'], url_path='feed',
+            permission_classes=[IsAuthenticated, ],
+            pagination_class=FeedPagination)
+    def feed(self, request):
+        """Новые рецепты авторов из подписок, листается курсором"""
+        return self.list(request)
+
+    def retrieve(self, request, *args, **kwargs):
+        """Рецепт из кеша готового JSON с флагами пользователя"""
+        recipe = self.get_object()
+        return recipe_cache.json_response(recipe_cache.render_recipes(
+            [recipe],
+            request,
+            self.serialize_recipes
+        )[0])
+
     def destroy(self, request, *args, **kwargs):
         """Удаляем рецепт, если есть права"""
         instance = self.get_object()
@@ -58,7 +263,11 @@ class RecipeViewSet(ModelViewSet):
         }
         if instance.author != request.user:
             return Response(response_data, status=status.HTTP_403_FORBIDDEN)
-        self.perform_destroy(instance)
+        with transaction.atomic():
+            shopping_list.recipe_deleted(instance)
+            recipe_cache.recipe_changed(instance.pk)
+            cook_index.recipe_deleted(instance.pk)
+            self.perform_destroy(instance)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     def partial_update(self, request, *args, **kwargs):
@@ -68,93 +277,256 @@ class RecipeViewSet(ModelViewSet):
         kwargs['partial'] = False
         return self.update(request, *args, **kwargs)
 
+    @action(detail=False, methods=['GET'], url_path='what_can_i_cook',
+            permission_classes=[AllowAny, ])
+    def what_can_i_cook(self, request):
+        """Рецепты по доле имеющихся ингредиентов (?ingredients=1&...)"""
+        ingredient_ids = [
+            int(value) for value in request.query_params.getlist(
+                'ingredients'
+            ) if value.isdigit()
+        ]
+        if not ingredient_ids:
+            return Response(
+                {'errors': 'ingredients are required'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        limit = request.query_params.get('limit', '')
+        limit = max(1, min(
+            int(limit) if limit.isdigit() else cook_index.COOK_LIMIT,
+            cook_index.MAX_COOK_LIMIT
+        ))
+        top = cook_index.get_index().top(ingredient_ids, limit)
+        recipes = Recipe.objects.in_bulk([recipe_id for recipe_id, *_ in top])
+        result = []
+        for recipe_id, matched, missing in top:
+            if recipe_id not in recipes:
+                continue
+            data = DetailRecipeSerializer(
+                recipes[recipe_id],
+                context={'request': request}
+            ).data
+            data['matched'] = matched
+            data['missing'] = missing
+            result.append(data)
+        return Response(result)
+
+    @action(detail=True, methods=['GET'], url_path='similar',
+            permission_classes=[AllowAny, ])
+    def similar(self, request, pk=None):
+        """Похожие рецепты из предрассчитанной таблицы"""
+        recipe = self.get_object()
+        limit = request.query_params.get('limit', '')
+        limit = min(
+            int(limit) if limit.isdigit() else SIMILAR_LIMIT,
+            SIMILAR_COUNT
+        )
+        result = []
+        for item in SimilarRecipe.objects.filter(
+            recipe=recipe
+        ).select_related('similar').order_by('-score')[:limit]:
+            data = DetailRecipeSerializer(
+                item.similar,
+                context={'request': request}
+            ).data
+            data['score'] = round(item.score, 4)
+            result.append(data)
+        return Response(result)
+
     @action(detail=True, methods=['POST', 'DELETE'], url_path='shopping_cart')
     def shopping_cart(self, request, pk=None):
         """Работа со списком покупок"""
         recipe = self.get_object()
         user = request.user
-        recipe_in_cart = user.user_recipes_cart.filter(recipe=recipe)
         if request.method == 'POST':
-            if recipe_in_cart:
+            with transaction.atomic():
+                lock_user(user)
+                created = create_once(
+                    ShoppingCart,
+                    user=user,
+                    recipe=recipe,
+                    in_shopping_card=True
+                )
+                if created:
+                    shopping_list.add_recipe(user, recipe)
+                    change_counter(recipe, 'cart_count', 1)
+            if not created:
                 return Response(
                     {'errors': 'recipe_in_cart already exists'},
                     status=status.HTTP_400_BAD_REQUEST
                 )
-            ShoppingCart.objects.create(
-                user=user,
-                recipe=recipe,
-                in_shopping_card=True
-            )
             recipe_serializer = DetailRecipeSerializer(recipe)
             return Response(
                 recipe_serializer.data,
                 status=status.HTTP_201_CREATED
             )
-        if request.method == 'DELETE':
-            if not recipe_in_cart:
-                return Response(
-                    {'errors': 'recipe_in_cart not found'},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
-            recipe_in_cart.delete()
-            return Response(status=status.HTTP_204_NO_CONTENT)
+        with transaction.atomic():
+            lock_user(user)
+            deleted, _ = ShoppingCart.objects.filter(
+                user=user,
+                recipe=recipe
+            ).delete()
+            if deleted:
+                shopping_list.remove_recipe(user, recipe)
+                change_counter(recipe, 'cart_count', -deleted)
+        if not deleted:
+            return Response(
+                {'errors': 'recipe_in_cart not found'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    @action(detail=False, methods=['POST'], url_path='shopping_cart/bulk')
+    def shopping_cart_bulk(self, request):
+        """Пакетная работа со списком покупок: add, remove, replace, clear"""
+        serializer = BulkRecipesSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        operation = serializer.validated_data['operation']
+        user = request.user
+        with transaction.atomic():
+            results, added, removed = bulk_user_recipes(
+                user,
+                ShoppingCart,
+                operation,
+                serializer.validated_data['recipes'],
+                in_shopping_card=True
+            )
+            if operation == 'clear':
+                shopping_list.clear(user)
+            else:
+                shopping_list.remove_recipes(user, removed)
+                shopping_list.add_recipes(user, added)
+            change_counters(added, 'cart_count', 1)
+            change_counters(removed, 'cart_count', -1)
+        return Response({'results': results})
 
     @action(detail=True, methods=['POST', 'DELETE'], url_path='favorite')
     def favorite(self, request, pk=None):
         """Работа с избранным"""
         recipe = self.get_object()
         user = request.user
-        recipe_in_favor = user.user_recipes_favor.filter(recipe=recipe)
         if request.method == 'POST':
-            if recipe_in_favor:
+            with transaction.atomic():
+                lock_user(user)
+                created = create_once(
+                    Favorite,
+                    user=user,
+                    recipe=recipe,
+                    in_favorite=True
+                )
+                if created:
+                    change_counter(recipe, 'favorite_count', 1)
+            if not created:
                 return Response(
                     {'errors': 'recipe_in_favore already exists'},
                     status=status.HTTP_400_BAD_REQUEST
                 )
-            Favorite.objects.create(
-                user=user,
-                recipe=recipe,
-                in_favorite=True
-            )
             recipe_serializer = DetailRecipeSerializer(recipe)
             return Response(
                 recipe_serializer.data,
                 status=status.HTTP_201_CREATED
             )
-        if request.method == 'DELETE':
-            if not recipe_in_favor:
-                return Response(
-                    {'errors': 'recipe_in_favore not found'},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
-            recipe_in_favor.delete()
+        with transaction.atomic():
+            lock_user(user)
+            deleted, _ = Favorite.objects.filter(
+                user=user,
+                recipe=recipe
+            ).delete()
+            change_counter(recipe, 'favorite_count', -deleted)
+        if not deleted:
+            return Response(
+                {'errors': 'recipe_in_favore not found'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+    @action(detail=False, methods=['POST'], url_path='favorite/bulk')
+    def favorite_bulk(self, request):
+        """Пакетная работа с избранным: add, remove, replace, clear"""
+        serializer = BulkRecipesSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        with transaction.atomic():
+            results, added, removed = bulk_user_recipes(
+                request.user,
+                Favorite,
+                serializer.validated_data['operation'],
+                serializer.validated_data['recipes'],
+                in_favorite=True
+            )
+            change_counters(added, 'favorite_count', 1)
+            change_counters(removed, 'favorite_count', -1)
+        return Response({'results': results})
+
+
+class Echo:
+    """Псевдо-буфер: csv.writer отдает строку сразу в генератор"""
+    def write(self, value):
+        return value
+
+
+def get_shopping_list_totals(user):
+    """Суммы ингредиентов из предрассчитанного списка покупок"""
+    return ShoppingListIngredient.objects.filter(
+        user=user
+    ).values(
+        'ingredient__name',
+        'ingredient__measurement_unit',
+        total=F('amount')
+    ).order_by('ingredient__name')
+
+
+def stream_csv(totals):
+    writer = csv.writer(Echo(), delimiter=',')
+    for item in totals:
+        yield writer.writerow([
+            f'{item["ingredient__name"]} '
+            f'({item["ingredient__measurement_unit"]}) - {item["total"]}'
+        ])
+
+
+def stream_txt(totals):
+    for item in totals:
+        yield (
+            f'{item["ingredient__name"]} '
+            f'({item["ingredient__measurement_unit"]}) - {item["total"]}\n'
+        )
+
+
+def stream_json(totals):
+    yield '['
+    separator = ''
+    for item in totals:
+        yield separator + json.dumps({
+            'name': item['ingredient__name'],
+            'measurement_unit': item['ingredient__measurement_unit'],
+            'amount': item['total'],
+        }, ensure_ascii=False)
+        separator = ','
+    yield ']'
+
+
+SHOPPING_LIST_FORMATS = {
+    'csv': (stream_csv, 'text/csv'),
+    'txt': (stream_txt, 'text/plain; charset=utf-8'),
+    'json': (stream_json, 'application/json'),
+}
+
 
 @api_view(['GET'])
 @login_required
 def dowload_shopping_list(request):
-    """Загрузка файла с ингредиентами в csv"""
-    file = HttpResponse(content_type='text/csv')
-    file['Content-Disposition'] = 'attachment; filename="shopping_list.csv"'
-    writer = csv.writer(file, delimiter=',')
-    ingredient_totals = {}
-    ingredient_units = {}
-    shopping_cart_items = request.user.user_recipes_cart.all()
-    for item in shopping_cart_items:
-        recipe = item.recipe
-        recipe_ingredients = recipe.recipe_ingredients.all()
-        for recipe_ingredient in recipe_ingredients:
-            ingredient_name = recipe_ingredient.ingredient.name
-            measure = recipe_ingredient.ingredient.measurement_unit
-            if ingredient_name in ingredient_totals:
-                ingredient_totals[ingredient_name] += recipe_ingredient.amount
-            else:
-                ingredient_totals[ingredient_name] = recipe_ingredient.amount
-                ingredient_units[ingredient_name] = measure
-    for ingredient, amount in ingredient_totals.items():
-        measure = ingredient_units[ingredient]
-        formatted_view = f'{ingredient} ({measure}) - {amount}'
-        writer.writerow([formatted_view])
-
+    """Загрузка файла с ингредиентами в csv, txt или json"""
+    file_format = request.query_params.get('file_format', 'csv')
+    if file_format not in SHOPPING_LIST_FORMATS:
+        return Response(
+            {'errors': f'file_format must be one of: '
+                       f'{", ".join(SHOPPING_LIST_FORMATS)}'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    stream, content_type = SHOPPING_LIST_FORMATS[file_format]
+    totals = get_shopping_list_totals(request.user).iterator()
+    file = StreamingHttpResponse(stream(totals), content_type=content_type)
+    file['Content-Disposition'] = (
+        f'attachment; filename="shopping_list.{file_format}"'
+    )
     return file
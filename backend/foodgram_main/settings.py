@@ -37,6 +37,21 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# Метрики запросов: Server-Timing, /api/metrics/ и поиск повторов SQL.
+# Метрики копятся в памяти каждого воркера, /api/metrics/ отдает
+# воркер, принявший запрос; без токена они доступны только сотрудникам
+INSTRUMENTATION = os.getenv(
+    'DJANGO_INSTRUMENTATION', 'False'
+).lower() == 'true'
+INSTRUMENTATION_N_PLUS_ONE = int(
+    os.getenv('DJANGO_INSTRUMENTATION_N_PLUS_ONE', 5)
+)
+INSTRUMENTATION_METRICS_TOKEN = os.getenv(
+    'DJANGO_INSTRUMENTATION_METRICS_TOKEN', ''
+)
+if INSTRUMENTATION:
+    MIDDLEWARE.insert(0, 'core.instrumentation.InstrumentationMiddleware')
+
 ROOT_URLCONF = 'foodgram_main.urls'
 
 TEMPLATES = [
@@ -68,6 +83,16 @@ DATABASES = {
     }
 }
 
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv(
+            'DJANGO_CACHE_BACKEND',
+            'django.core.cache.backends.locmem.LocMemCache'
+        ),
+        'LOCATION': os.getenv('DJANGO_CACHE_LOCATION', ''),
+    }
+}
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
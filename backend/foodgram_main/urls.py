@@ -1,6 +1,8 @@
 from django.contrib import admin
 from django.urls import include, path
 
+from core.views import metrics
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/users/', include('users.urls')),
@@ -8,6 +10,7 @@ urlpatterns = [
     path('api/tags/', include('food.tag_urls')),
     path('api/ingredients/', include('food.ingredient_urls')),
     path('api/recipes/', include('food.recipe_urls')),
+    path('api/metrics/', metrics),
 ]
 
 handler404 = 'core.views.page_not_found'
@@ -0,0 +1,39 @@
+# Generated by Django 3.2.3 on 2026-10-18 17:36
+
+from django.db import migrations
+from django.db.models import Count, Min
+
+
+def remove_duplicate_subscriptions(apps, schema_editor):
+    """Повторные подписки без уникальности: остается самая ранняя"""
+    Subscribe = apps.get_model('users', 'Subscribe')
+    duplicates = Subscribe.objects.values(
+        'follow_id',
+        'follower_id'
+    ).annotate(
+        rows=Count('id'),
+        first_id=Min('id')
+    ).filter(rows__gt=1).order_by()
+    for duplicate in duplicates:
+        Subscribe.objects.filter(
+            follow_id=duplicate['follow_id'],
+            follower_id=duplicate['follower_id']
+        ).exclude(id=duplicate['first_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            remove_duplicate_subscriptions,
+            migrations.RunPython.noop
+        ),
+        migrations.AlterUniqueTogether(
+            name='subscribe',
+            unique_together={('follow', 'follower')},
+        ),
+    ]
@@ -22,5 +22,8 @@ class Subscribe(models.Model):
         related_name='follower'
     )
 
+    class Meta:
+        unique_together = ('follow', 'follower', )
+
     def __str__(self):
         return f"{self.follower} подписан на {self.follow}"
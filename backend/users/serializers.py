@@ -1,19 +1,25 @@
 from djoser.serializers import UserSerializer
 from rest_framework import serializers
 
+from core.instrumentation import TimedSerializerMixin
+from food.fields import ImageVariantsField
 from food.models import Recipe
+from food.viewer_state import ViewerStateListSerializer, get_viewer_state
 
-from .models import Subscribe, User
+from .models import User
 
 
-class DetailRecipeSerializer(serializers.ModelSerializer):
+class DetailRecipeSerializer(TimedSerializerMixin,
+                             serializers.ModelSerializer):
     """Сокращенный сериализатор рецепта"""
+    image_variants = ImageVariantsField()
+
     class Meta:
         model = Recipe
-        fields = ('id', 'name', 'image', 'cooking_time')
+        fields = ('id', 'name', 'image', 'image_variants', 'cooking_time')
 
 
-class CustomUserSerializer(serializers.ModelSerializer):
+class CustomUserSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     """Кастомный сериализатор для создания пользователя"""
     password = serializers.CharField(write_only=True)
     first_name = serializers.CharField(required=True)
@@ -44,16 +50,14 @@ class CustomUserSerializer(serializers.ModelSerializer):
 
     def get_is_subscribed(self, follow):
         """Для определения is_subscribe"""
-        follower = self.context['request'].user
-        if follower.is_anonymous:
-            return False
-        return Subscribe.objects.filter(
-            follow=follow,
-            follower=follower
-        ).exists()
+        return get_viewer_state(self.context).is_subscribed(follow.id)
+
+    def prime_viewer_state(self, state, users):
+        state.prime_authors([user.id for user in users])
 
     class Meta:
         model = User
+        list_serializer_class = ViewerStateListSerializer
         fields = (
             'email',
             'id',
@@ -65,10 +69,20 @@ class CustomUserSerializer(serializers.ModelSerializer):
         )
 
 
-class CustomMeSerializer(UserSerializer):
+class CustomMeSerializer(TimedSerializerMixin, UserSerializer):
     """Переопределение сериализатора Djoser для /me/"""
+    is_subscribed = serializers.SerializerMethodField()
+
+    def get_is_subscribed(self, follow):
+        """Подписка текущего пользователя на автора"""
+        return get_viewer_state(self.context).is_subscribed(follow.id)
+
+    def prime_viewer_state(self, state, users):
+        state.prime_authors([user.id for user in users])
+
     class Meta:
         model = User
+        list_serializer_class = ViewerStateListSerializer
         fields = (
             'email',
             'id',
@@ -79,7 +93,7 @@ class CustomMeSerializer(UserSerializer):
         )
 
 
-class SubscribeSerializer(serializers.ModelSerializer):
+class SubscribeSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     """Сериализатор для подписок"""
     recipes = serializers.SerializerMethodField()
     recipes_count = serializers.SerializerMethodField()
@@ -87,32 +101,27 @@ class SubscribeSerializer(serializers.ModelSerializer):
 
     def get_recipes(self, follow):
         """Возвращение рецептов фолоува"""
-        recipes = Recipe.objects.filter(author=follow)
+        recipes = getattr(follow, 'recent_recipes', None)
+        if recipes is None:
+            recipes = Recipe.objects.filter(author=follow)
+            recipes_limit = self.context.get('recipes_limit')
+            if recipes_limit is not None:
+                recipes = recipes[:recipes_limit]
         serializer = DetailRecipeSerializer(recipes, many=True)
 
         return serializer.data
 
     def get_recipes_count(self, follow):
         """Вернет количество рецептов после recipes"""
+        if hasattr(follow, 'recipes_count'):
+            return follow.recipes_count
         return Recipe.objects.filter(author=follow).count()
 
     def get_is_subscribed(self, follow):
         """Для работы is_subscribed"""
-        follower = self.context['request'].user
-        return Subscribe.objects.filter(
-            follow=follow,
-            follower=follower
-        ).exists()
-
-    def to_representation(self, instance):
-        """Для ограничения вложенных рецептов"""
-        data = super().to_representation(instance)
-        recipes_limit = self.context.get('recipes_limit')
-        print(recipes_limit)
-        if recipes_limit is not None:
-            data['recipes'] = data['recipes'][:recipes_limit]
-            data['recipes_count'] = recipes_limit
-        return data
+        if hasattr(follow, 'subscribed'):
+            return follow.subscribed
+        return get_viewer_state(self.context).is_subscribed(follow.id)
 
     class Meta:
         model = User
@@ -1,19 +1,116 @@
+import base64
+import json
+from collections import defaultdict
+from datetime import datetime
+
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+from django.db.models import BooleanField, Count, Q, Value
 from rest_framework import status
 from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound
 from rest_framework.generics import ListAPIView, RetrieveAPIView
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 from rest_framework.viewsets import ModelViewSet
 
+from food.models import Recipe
+
 from .models import Subscribe, User
 from .serializers import CustomUserSerializer, SubscribeSerializer
 
 
 class ListPagination(PageNumberPagination):
-    """Паджинатор с лимитом"""
+    """Паджинатор с лимитом.
+    С параметром cursor (для первой страницы пустым) переходит
+    в режим keyset по полям view.keyset_ordering: без OFFSET и COUNT"""
     page_size = 5
     page_size_query_param = 'limit'
+    cursor_query_param = 'cursor'
+    keyset_ordering = None
+    keyset_only = False
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset_ordering = None
+        if self.keyset_only or (
+            self.cursor_query_param in request.query_params
+        ):
+            self.keyset_ordering = getattr(view, 'keyset_ordering', None)
+        if self.keyset_ordering is None:
+            return super().paginate_queryset(queryset, request, view)
+        self.request = request
+        queryset = queryset.order_by(*self.keyset_ordering)
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            queryset = queryset.filter(
+                self.after_position(cursor, queryset.model)
+            )
+        page_size = self.get_page_size(request)
+        items = list(queryset[:page_size + 1])
+        self.next_position = None
+        if len(items) > page_size:
+            items = items[:page_size]
+            self.next_position = [
+                getattr(items[-1], field.lstrip('-'))
+                for field in self.keyset_ordering
+            ]
+        return items
+
+    def after_position(self, cursor, model):
+        """Условие "строго после позиции курсора" для keyset_ordering.
+        Значения курсора приводятся к типам полей model"""
+        try:
+            position = json.loads(
+                base64.urlsafe_b64decode(cursor.encode()).decode()
+            )
+        except (TypeError, ValueError):
+            raise NotFound('Invalid cursor')
+        if (
+            not isinstance(position, list)
+            or len(position) != len(self.keyset_ordering)
+        ):
+            raise NotFound('Invalid cursor')
+        condition = Q()
+        equal = {}
+        for field, value in zip(self.keyset_ordering, position):
+            name = field.lstrip('-')
+            try:
+                value = model._meta.get_field(name).to_python(value)
+            except (ValidationError, TypeError, ValueError):
+                raise NotFound('Invalid cursor')
+            if value is None:
+                raise NotFound('Invalid cursor')
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            condition |= Q(**equal, **{f'{name}__{lookup}': value})
+            equal[name] = value
+        return condition
+
+    def get_next_link(self):
+        """Даты в курсоре с микросекундами: при округлении условие
+        "после позиции" пропустило бы строки внутри той же миллисекунды"""
+        if self.keyset_ordering is None:
+            return super().get_next_link()
+        if self.next_position is None:
+            return None
+        cursor = base64.urlsafe_b64encode(json.dumps([
+            value.isoformat() if isinstance(value, datetime) else value
+            for value in self.next_position
+        ]).encode()).decode()
+        return replace_query_param(
+            self.request.build_absolute_uri(),
+            self.cursor_query_param,
+            cursor
+        )
+
+    def get_paginated_response(self, data):
+        if self.keyset_ordering is None:
+            return super().get_paginated_response(data)
+        return Response({
+            'next': self.get_next_link(),
+            'results': data,
+        })
 
 
 class UserView(ModelViewSet):
@@ -22,6 +119,7 @@ class UserView(ModelViewSet):
     serializer_class = CustomUserSerializer
     permission_classes = [AllowAny, ]
     pagination_class = ListPagination
+    keyset_ordering = ('id', )
 
 
 class UserDetailView(RetrieveAPIView):
@@ -42,24 +140,22 @@ class SubscribeView(ModelViewSet):
         """Подписка через /subscribe"""
         follow = self.get_object()
         follower = request.user
-        is_sub = Subscribe.objects.filter(
-            follow=follow,
-            follower=follower
-        ).exists()
         if follow == follower:
             return Response(
                 {"errors": "It's crazy to subscribe to yourself"},
                 status=status.HTTP_400_BAD_REQUEST
             )
-        if is_sub:
+        try:
+            with transaction.atomic():
+                Subscribe.objects.create(
+                    follow=follow,
+                    follower=follower
+                )
+        except IntegrityError:
             return Response(
                 {"errors": "Subscribe already exists"},
                 status=status.HTTP_400_BAD_REQUEST
             )
-        Subscribe.objects.create(
-            follow=follow,
-            follower=follower
-        )
         sub_serializer = SubscribeSerializer(
             follow,
             context={'request': request}
@@ -70,20 +166,15 @@ class SubscribeView(ModelViewSet):
     def unsubscribe(self, request, pk=None):
         """Отписка через /subscribe"""
         follow = self.get_object()
-        follower = request.user
-        is_sub = Subscribe.objects.filter(
+        deleted, _ = Subscribe.objects.filter(
             follow=follow,
-            follower=follower
-        ).exists()
-        if not is_sub:
+            follower=request.user
+        ).delete()
+        if not deleted:
             return Response(
                 {"errors": "Subscribe not found"},
                 status=status.HTTP_400_BAD_REQUEST
             )
-        Subscribe.objects.get(
-            follow=follow,
-            follower=follower
-        ).delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
@@ -92,13 +183,20 @@ class SubscribeListView(ListAPIView):
     serializer_class = SubscribeSerializer
     permission_classes = [IsAuthenticated, ]
     pagination_class = ListPagination
+    keyset_ordering = ('id', )
+
+    def get_recipes_limit(self):
+        recipes_limit = self.request.query_params.get('recipes_limit')
+        if recipes_limit and recipes_limit.isdigit():
+            return int(recipes_limit)
+        return None
 
     def get_serializer_context(self):
         """передача параметра сериализатору для ограничения"""
         context = super().get_serializer_context()
-        recipes_limit = self.request.query_params.get('recipes_limit')
-        if recipes_limit:
-            context['recipes_limit'] = int(recipes_limit)
+        recipes_limit = self.get_recipes_limit()
+        if recipes_limit is not None:
+            context['recipes_limit'] = recipes_limit
         return context
 
     def get_queryset(self):
@@ -106,4 +204,25 @@ class SubscribeListView(ListAPIView):
         subscribed_users = Subscribe.objects.filter(
             follower=self.request.user
         ).values_list('follow_id', flat=True)
-        return User.objects.filter(id__in=subscribed_users)
+        return User.objects.filter(id__in=subscribed_users).annotate(
+            recipes_count=Count('recipe'),
+            subscribed=Value(True, BooleanField()),
+        ).order_by('id')
+
+    def paginate_queryset(self, queryset):
+        """Рецепты всех авторов страницы подгружаются одним запросом"""
+        page = super().paginate_queryset(queryset)
+        authors = list(queryset if page is None else page)
+        recipes = Recipe.objects.filter(
+            author_id__in=[author.id for author in authors]
+        )
+        recipes_limit = self.get_recipes_limit()
+        if recipes_limit is not None:
+            recipes = recipes.newest_per_author(recipes_limit)
+        recipes_by_author = defaultdict(list)
+        for recipe in recipes.only('id', 'name', 'image', 'image_variants',
+                                   'cooking_time', 'author_id', 'created_at'):
+            recipes_by_author[recipe.author_id].append(recipe)
+        for author in authors:
+            author.recent_recipes = recipes_by_author[author.id]
+        return page